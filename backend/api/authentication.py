@@ -0,0 +1,78 @@
+import hashlib
+
+from core.local_cache import LocalLRUCache
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+TOKEN_KEY = 'auth_token:{}'
+# Поля пользователя в кеше аутентификации. Пароля и счётчиков здесь нет:
+# они читаются из БД при обращении, а save() их не перезаписывает.
+AUTH_FIELDS = (
+    'id', 'email', 'username', 'first_name', 'last_name',
+    'is_active', 'is_staff', 'is_superuser',
+)
+
+_local_tokens = LocalLRUCache(
+    settings.AUTH_TOKEN_LOCAL_SIZE, settings.AUTH_TOKEN_LOCAL_TTL
+)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication без запроса к БД на каждый запрос.
+
+    Пользователь по токену ищется в LRU процесса, затем в Redis, и только
+    потом в БД. В кеше лежат только поля AUTH_FIELDS под хешем токена,
+    так что ни токен, ни хеш пароля в Redis не попадают. Выход, смена
+    пароля, деактивация и удаление сбрасывают запись (см. forget_token);
+    в других процессах она живёт не дольше AUTH_TOKEN_LOCAL_TTL.
+    """
+
+    def authenticate_credentials(self, key):
+        digest = token_digest(key)
+        fields = _local_tokens.get(digest)
+        if fields is None:
+            fields = cache.get(TOKEN_KEY.format(digest))
+            if fields is None:
+                # Неверный токен или неактивный пользователь: исключение.
+                user, _ = super().authenticate_credentials(key)
+                fields = {field: getattr(user, field) for field in AUTH_FIELDS}
+                cache.set(
+                    TOKEN_KEY.format(digest), fields,
+                    settings.AUTH_TOKEN_CACHE_TTL,
+                )
+            _local_tokens.set(digest, fields)
+        user = _user_from_fields(fields)
+        return user, Token(key=key, user=user)
+
+
+def _user_from_fields(fields):
+    """Пользователь, у которого не из кеша поля отложены до обращения."""
+    names = [
+        field.attname for field in get_user_model()._meta.concrete_fields
+        if field.attname in fields
+    ]
+    return get_user_model().from_db(
+        DEFAULT_DB_ALIAS, names, [fields[name] for name in names]
+    )
+
+
+def token_digest(key):
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def forget_token(key):
+    """Сбросить закешированного пользователя токена в этом процессе и Redis."""
+    digest = token_digest(key)
+    _local_tokens.delete(digest)
+    cache.delete(TOKEN_KEY.format(digest))
+
+
+def forget_user_tokens(user_id):
+    for key in Token.objects.filter(
+        user_id=user_id
+    ).values_list('key', flat=True):
+        forget_token(key)
@@ -0,0 +1,55 @@
+from django.http import Http404
+
+from .serializers import BulkIdsSerializer
+
+ADDED = 'added'
+REMOVED = 'removed'
+UNCHANGED = 'unchanged'
+NOT_FOUND = 'not_found'
+NOT_ALLOWED = 'not_allowed'
+
+
+def parse_pk(value):
+    """id объекта из URL; нечисловой id означает, что объекта нет."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise Http404
+
+
+def change_relations(request, manager, target_model, forbidden=()):
+    """Массово добавить (POST) или удалить (DELETE) связи пользователя.
+
+    Изменение - один INSERT или DELETE; ещё один запрос нужен, только
+    чтобы отличить отсутствующие объекты от уже (не) связанных.
+    Возвращает результаты по каждому id в порядке запроса.
+    """
+    serializer = BulkIdsSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)
+    ids = list(dict.fromkeys(serializer.validated_data['ids']))
+    allowed = [pk for pk in ids if pk not in forbidden]
+    if request.method == 'POST':
+        done = manager.add_many(request.user.pk, allowed)
+        done_status = ADDED
+    else:
+        done = manager.remove_many(request.user.pk, allowed)
+        done_status = REMOVED
+
+    done = set(done)
+    rest = [pk for pk in allowed if pk not in done]
+    existing = set(
+        target_model.objects.filter(pk__in=rest).values_list('pk', flat=True)
+    ) if rest else set()
+
+    def result(pk):
+        if pk in done:
+            return done_status
+        if pk in forbidden:
+            return NOT_ALLOWED
+        return UNCHANGED if pk in existing else NOT_FOUND
+
+    return [{'id': pk, 'status': result(pk)} for pk in ids]
+
+
+def has_changes(results):
+    return any(item['status'] in (ADDED, REMOVED) for item in results)
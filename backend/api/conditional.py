@@ -0,0 +1,78 @@
+import hashlib
+from functools import wraps
+
+from core.cache import get_generations
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+
+def conditional(view_method):
+    """Ответить 304, если валидаторы совпали, не вызывая обработчик.
+
+    ETag собирается из счётчиков поколений кеша и полей строки, а не
+    из хеша готового тела, поэтому проверка не трогает сериализатор.
+    """
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        etag, last_modified = self.get_validators(request)
+        not_modified = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if not_modified is not None:
+            return not_modified
+        response = view_method(self, request, *args, **kwargs)
+        if response.status_code == 200 and etag is not None:
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+        return response
+    return wrapper
+
+
+class ConditionalGetMixin:
+    """ETag и Last-Modified для list и retrieve.
+
+    Вьюсет описывает в ``get_etag_source``, от чего зависит ответ:
+    пространства имён кеша, значения строки объекта и время её
+    изменения. Ответы с флагами зрителя зависят ещё и от его
+    поколения ``viewer:<id>``.
+    """
+
+    viewer_dependent = True
+
+    @conditional
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @conditional
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+    def get_etag_source(self):
+        """(пространства имён, значения строки, время изменения) или None.
+
+        None - валидаторы не считаются, например если объекта нет.
+        """
+        return (), (), None
+
+    def get_validators(self, request):
+        source = self.get_etag_source()
+        if source is None:
+            return None, None
+        namespaces, row, last_modified = source
+        namespaces = list(namespaces)
+        parts = [request.accepted_renderer.format, *row]
+        user = request.user
+        viewer = self.viewer_dependent and user.is_authenticated
+        if viewer:
+            namespaces.append(f'viewer:{user.pk}')
+            parts.append(user.pk)
+        parts.extend(get_generations(*namespaces))
+        digest = hashlib.md5(
+            ':'.join(map(str, parts)).encode(), usedforsecurity=False
+        ).hexdigest()
+        # Время изменения строки не отражает флаги зрителя, поэтому
+        # Last-Modified отдаём только для ответов без них.
+        if viewer or last_modified is None:
+            return f'W/"{digest}"', None
+        return f'W/"{digest}"', int(last_modified.timestamp())
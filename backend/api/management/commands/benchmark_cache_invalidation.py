@@ -0,0 +1,118 @@
+import statistics
+import time
+
+from core.cache import get_generations
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.test.utils import override_settings
+from django_redis import get_redis_connection
+from recipes.models import Recipe, clear_recipe_cache
+
+User = get_user_model()
+
+BATCH_SIZE = 10_000
+# Ответ списка рецептов в кеше: размер типичной страницы.
+PAGE = b'{"count": 0, "results": []}'.ljust(8 * 1024)
+
+
+def legacy_clear_recipe_cache(sender, instance, **kwargs):
+    """Прежний сброс кеша рецептов: три SCAN по всему Redis."""
+    cache.delete_pattern('popular_recipes*')
+    cache.delete_pattern(f'recipe_{instance.id}*')
+    cache.delete_pattern('paginated_*')
+
+
+class Command(BaseCommand):
+    help = ('Measure Recipe save latency with a large number of cached '
+            'keys in Redis, with generation counters and delete_pattern')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keys', type=int, default=1_000_000)
+        parser.add_argument('--rounds', type=int, default=200)
+        parser.add_argument(
+            '--legacy-rounds', type=int, default=20,
+            help='Saves with the old delete_pattern receivers',
+        )
+        parser.add_argument('--ttl', type=int, default=600)
+
+    def handle(self, *args, **options):
+        # Свой префикс ключей: рабочий кеш и его поколения не трогаем.
+        params = settings.CACHES['default']
+        with override_settings(CACHES={
+            **settings.CACHES,
+            'default': {**params, 'KEY_PREFIX': 'benchmark'},
+        }):
+            author = User.objects.create_user(
+                username='cache-benchmark',
+                email='cache-benchmark@example.com',
+                first_name='cache', last_name='benchmark',
+            )
+            try:
+                recipe = Recipe.objects.create(
+                    author=author, name='benchmark', text='benchmark',
+                    cooking_time=1,
+                )
+                self.fill_cache(options['keys'], options['ttl'])
+                self.report('generation counters', self.time_saves(
+                    recipe, options['rounds']
+                ))
+                self.report('delete_pattern', self.time_legacy_saves(
+                    recipe, options['legacy_rounds']
+                ))
+            finally:
+                author.delete()
+                self.stdout.write('Cleaning up...')
+                cache.delete_pattern('*')
+
+    def fill_cache(self, count, ttl):
+        """Записи get_or_compute под стабильными ключами списков."""
+        self.stdout.write(f'Filling {count} keys...')
+        client = get_redis_connection('default')
+        generations = get_generations('recipes')
+        entry = cache.client.encode((
+            PAGE, generations, time.time() + ttl, 0.05, len(PAGE)
+        ))
+        pipe = client.pipeline(transaction=False)
+        for i in range(count):
+            pipe.set(
+                cache.make_key(f'recipes:http://benchmark/api/recipes/'
+                               f'?page={i}'),
+                entry, ex=ttl,
+            )
+            if i % BATCH_SIZE == 0:
+                pipe.execute()
+        pipe.execute()
+
+    def time_saves(self, recipe, rounds):
+        timings = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            # Поколения сдвигаются после коммита: он входит в замер.
+            with transaction.atomic():
+                recipe.save()
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    def time_legacy_saves(self, recipe, rounds):
+        # Шаблоны прежних ключей не совпадают с записями get_or_compute:
+        # SCAN проходит все ключи, а заполненные остаются на месте.
+        post_save.disconnect(clear_recipe_cache, sender=Recipe)
+        post_save.connect(legacy_clear_recipe_cache, sender=Recipe)
+        try:
+            return self.time_saves(recipe, rounds)
+        finally:
+            post_save.disconnect(legacy_clear_recipe_cache, sender=Recipe)
+            post_save.connect(clear_recipe_cache, sender=Recipe)
+
+    def report(self, label, timings):
+        timings.sort()
+        p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+        self.stdout.write(self.style.SUCCESS(
+            f'Recipe.save, {label}: '
+            f'median {statistics.median(timings):.2f} ms, '
+            f'p99 {p99:.2f} ms, max {timings[-1]:.2f} ms'
+        ))
@@ -0,0 +1,84 @@
+import random
+import statistics
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from recipes.filters import IngredientFilter, RecipeFilter
+from recipes.models import Ingredient, Recipe
+
+User = get_user_model()
+
+BATCH_SIZE = 10_000
+
+
+class Command(BaseCommand):
+    help = 'Measure fuzzy search latency for recipes and ingredients'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Create this many synthetic recipes before measuring',
+        )
+        parser.add_argument('--queries', type=int, default=500)
+        parser.add_argument('--limit', type=int, default=10)
+
+    def handle(self, *args, **options):
+        words = list(Ingredient.objects.values_list('name', flat=True))
+        if not words:
+            raise CommandError('Сначала загрузите ингредиенты.')
+        if options['seed']:
+            self.seed(options['seed'], words)
+
+        queries = [
+            self.typo(random.choice(words))
+            for _ in range(options['queries'])
+        ]
+        for label, filterset, queryset in (
+            ('recipes', RecipeFilter, Recipe.objects.all()),
+            ('ingredients', IngredientFilter, Ingredient.objects.all()),
+        ):
+            self.report(label, self.measure(
+                filterset, queryset, queries, options['limit']
+            ))
+
+    def seed(self, count, words):
+        author = User.objects.order_by('id').first()
+        if author is None:
+            raise CommandError('Нужен хотя бы один пользователь.')
+        self.stdout.write(f'Creating {count} recipes...')
+        for start in range(0, count, BATCH_SIZE):
+            Recipe.objects.bulk_create([
+                Recipe(
+                    name=' '.join(random.sample(words, 3)),
+                    text='',
+                    author=author,
+                    cooking_time=random.randint(1, 120),
+                )
+                for _ in range(min(BATCH_SIZE, count - start))
+            ])
+
+    def typo(self, word):
+        """Слово с одной случайной опечаткой, как при наборе."""
+        word = word.split()[0]
+        if len(word) < 4:
+            return word
+        i = random.randrange(1, len(word) - 1)
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+    def measure(self, filterset, queryset, queries, limit):
+        filter_search = filterset(queryset=queryset).filter_search
+        timings = []
+        for query in queries:
+            start = time.perf_counter()
+            list(filter_search(queryset, 'search', query)[:limit])
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    def report(self, label, timings):
+        timings.sort()
+        p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+        self.stdout.write(self.style.SUCCESS(
+            f'{label}: median {statistics.median(timings):.2f} ms, '
+            f'p99 {p99:.2f} ms'
+        ))
@@ -0,0 +1,50 @@
+from collections import defaultdict
+
+from core.cache import STATS_KEY
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+
+OUTCOMES = ('local', 'redis', 'miss')
+
+
+class Command(BaseCommand):
+    help = 'Show two-tier cache hit statistics per key namespace'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset', action='store_true',
+            help='Clear the collected statistics after printing',
+        )
+
+    def handle(self, *args, **options):
+        client = get_redis_connection('default')
+        stats = defaultdict(dict)
+        for field, value in client.hgetall(STATS_KEY).items():
+            namespace, _, outcome = field.decode().rpartition(':')
+            stats[namespace][outcome] = float(value)
+        # Периоды работы без Redis (core.cache_backend).
+        degraded = stats.pop('degraded', {})
+
+        self.stdout.write(
+            f'{"namespace":<16}{"local":>10}{"redis":>10}{"miss":>10}'
+            f'{"hit %":>8}'
+        )
+        for namespace in sorted(stats):
+            counts = [
+                int(stats[namespace].get(outcome, 0)) for outcome in OUTCOMES
+            ]
+            total = sum(counts)
+            hit_rate = 100 * (counts[0] + counts[1]) / total if total else 0
+            self.stdout.write(
+                f'{namespace:<16}'
+                + ''.join(f'{count:>10}' for count in counts)
+                + f'{hit_rate:>8.1f}'
+            )
+        if degraded:
+            self.stdout.write(
+                f'Redis outages: {int(degraded.get("outages", 0))}, '
+                f'{degraded.get("seconds", 0):.1f} s on local cache, '
+                f'{int(degraded.get("fallback_calls", 0))} fallback calls'
+            )
+        if options['reset']:
+            client.delete(STATS_KEY)
@@ -0,0 +1,62 @@
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ('Exercise the cache in a loop and report switches between Redis '
+            'and the local fallback; stop and start Redis while it runs')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--duration', type=float, default=60,
+            help='How long to run, seconds',
+        )
+        parser.add_argument(
+            '--interval', type=float, default=0.1,
+            help='Pause between cache round trips, seconds',
+        )
+
+    def handle(self, *args, **options):
+        if not hasattr(cache, 'is_degraded'):
+            raise CommandError(
+                'The default cache is not core.cache_backend.'
+                'ResilientRedisCache'
+            )
+        deadline = time.monotonic() + options['duration']
+        degraded = cache.is_degraded
+        calls = slowest = 0
+        total = 0.0
+        self.report(0, 0.0, 0.0)
+        step = 0
+        while time.monotonic() < deadline:
+            key = f'check_cache_fallback:{step % 100}'
+            start = time.perf_counter()
+            cache.set(key, step, 60)
+            value = cache.get(key)
+            elapsed = (time.perf_counter() - start) * 1000
+            if value != step:
+                self.stderr.write(f'Read {value!r} instead of {step}')
+            calls += 1
+            total += elapsed
+            slowest = max(slowest, elapsed)
+            if cache.is_degraded != degraded:
+                self.report(calls, total, slowest)
+                degraded = cache.is_degraded
+                calls = slowest = 0
+                total = 0.0
+            step += 1
+            time.sleep(options['interval'])
+        self.report(calls, total, slowest)
+        self.stdout.write(f'Outages: {cache.degraded_stats["outages"]}')
+
+    def report(self, calls, total, slowest):
+        """Напечатать задержки прошедшего периода и новое состояние."""
+        if calls:
+            self.stdout.write(
+                f'  {calls} round trips, avg {total / calls:.2f} ms, '
+                f'max {slowest:.2f} ms'
+            )
+        state = 'local fallback' if cache.is_degraded else 'redis'
+        self.stdout.write(f'{time.strftime("%H:%M:%S")} cache: {state}')
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from recipes.models import ShoppingCartIngredient
+
+
+class Command(BaseCommand):
+    help = ('Compare shopping cart totals with the SUM over cart recipes; '
+            'optionally repair the totals')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fix', action='store_true',
+            help='Rebuild totals of users with mismatches',
+        )
+
+    def handle(self, *args, **options):
+        mismatches = ShoppingCartIngredient.objects.mismatches()
+        if not mismatches:
+            self.stdout.write(self.style.SUCCESS('Shopping carts are in sync'))
+            return
+        for (user_id, ingredient_id), (expected, actual) in sorted(
+            mismatches.items()
+        ):
+            self.stdout.write(
+                f'user {user_id}, ingredient {ingredient_id}: '
+                f'expected {expected}, stored {actual}'
+            )
+        if options['fix']:
+            ShoppingCartIngredient.objects.rebuild(
+                {user_id for user_id, _ in mismatches}
+            )
+            self.stdout.write(self.style.SUCCESS('Totals rebuilt'))
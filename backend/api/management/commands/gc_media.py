@@ -0,0 +1,69 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from foodgram_api.images import forget_variants
+from foodgram_api.media import referenced_files
+
+
+class Command(BaseCommand):
+    help = 'Remove files under MEDIA_ROOT that no model references'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true')
+        parser.add_argument(
+            '--workers', type=int, default=8,
+            help='Directories scanned in parallel',
+        )
+        parser.add_argument(
+            '--grace', type=int, default=settings.MEDIA_GRACE_PERIOD,
+            help='Keep files modified less than this many seconds ago',
+        )
+
+    def handle(self, *args, **options):
+        self.root = str(settings.MEDIA_ROOT)
+        self.dry_run = options['dry_run']
+        # Файлы моложе порога могли только что загрузить: ссылка на них
+        # появится в БД после коммита.
+        self.cutoff = time.time() - options['grace']
+        self.referenced = referenced_files()
+
+        directories = [path for path, _, _ in os.walk(self.root)]
+        with ThreadPoolExecutor(max_workers=options['workers']) as pool:
+            results = list(pool.map(self.collect_directory, directories))
+
+        scanned = sum(result[0] for result in results)
+        removed = [name for result in results for name in result[1]]
+        freed = sum(result[2] for result in results)
+        if not self.dry_run:
+            # Удалённые копии больше не готовы: их может понадобиться
+            # собрать заново для той же картинки.
+            forget_variants(removed)
+        verb = 'Would remove' if self.dry_run else 'Removed'
+        self.stdout.write(self.style.SUCCESS(
+            f'Scanned {scanned} files. {verb} {len(removed)} files, '
+            f'{freed / 1024 / 1024:.1f} MB'
+        ))
+
+    def collect_directory(self, path):
+        """Удалить файлы каталога без ссылок: (всего, удалённые, байт)."""
+        scanned = freed = 0
+        removed = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                scanned += 1
+                name = os.path.relpath(entry.path, self.root).replace(
+                    os.sep, '/'
+                )
+                stat = entry.stat()
+                if name in self.referenced or stat.st_mtime > self.cutoff:
+                    continue
+                if not self.dry_run:
+                    os.remove(entry.path)
+                removed.append(name)
+                freed += stat.st_size
+        return scanned, removed, freed
@@ -1,6 +1,7 @@
 import json
 import os
 
+from core.cache import bump_generation
 from django.core.management.base import BaseCommand
 from recipes.models import Ingredient
 
@@ -25,6 +26,9 @@ class Command(BaseCommand):
             Ingredient.objects.bulk_create(
                 ingredient_objects, ignore_conflicts=True
             )
+        # bulk_create не шлёт сигналов, поэтому индексы и кеш
+        # ингредиентов сбрасываем явно.
+        bump_generation('ingredients')
 
         self.stdout.write(
             self.style.SUCCESS(
@@ -0,0 +1,62 @@
+from core.counters import forget_counters
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from recipes.models import Favorite, Recipe, ShoppingCart
+from users.models import Follow, User
+
+# (модель, счётчик, связанная модель, внешний ключ на модель)
+COUNTERS = (
+    (Recipe, 'favorites_count', Favorite, 'recipe'),
+    (Recipe, 'in_carts_count', ShoppingCart, 'recipe'),
+    (User, 'recipes_count', Recipe, 'author'),
+    (User, 'followers_count', Follow, 'following'),
+)
+
+
+class Command(BaseCommand):
+    help = 'Recount denormalized counters and fix the ones that drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only report how many rows have drifted',
+        )
+
+    def handle(self, *args, **options):
+        for model, field, related, foreign_key in COUNTERS:
+            with transaction.atomic():
+                actual = self.actual_count(related, foreign_key)
+                drifted = model.objects.annotate(
+                    actual=actual
+                ).exclude(**{field: F('actual')})
+                if options['dry_run']:
+                    count = drifted.count()
+                else:
+                    ids = list(drifted.values_list('pk', flat=True))
+                    count = model.objects.filter(
+                        pk__in=ids
+                    ).update(**{field: actual})
+                    forget_counters(model, ids)
+            label = f'{model._meta.model_name}.{field}'
+            if count:
+                self.stdout.write(self.style.WARNING(
+                    f'{label}: {count} drifted rows'
+                    + ('' if options['dry_run'] else ' fixed')
+                ))
+            else:
+                self.stdout.write(self.style.SUCCESS(f'{label}: in sync'))
+
+    def actual_count(self, related, foreign_key):
+        """Подзапрос с настоящим числом связанных записей."""
+        return Coalesce(
+            Subquery(
+                related.objects.filter(
+                    **{foreign_key: OuterRef('pk')}
+                ).order_by().values(foreign_key).annotate(
+                    total=Count('pk')
+                ).values('total')
+            ),
+            Value(0),
+        )
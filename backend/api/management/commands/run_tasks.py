@@ -0,0 +1,78 @@
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from core.tasks import (QUEUE_KEY, blocking_client, claim, promote_delayed,
+                        record_result, run_message)
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+from django.utils.module_loading import autodiscover_modules
+
+
+def run_pooled(message):
+    """run_message в процессе пула, между проверками соединений с БД."""
+    close_old_connections()
+    try:
+        return run_message(message)
+    finally:
+        close_old_connections()
+
+
+class Command(BaseCommand):
+    help = 'Run background tasks from the Redis queue in a process pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count(),
+            help='Number of worker processes',
+        )
+        parser.add_argument(
+            '--burst', action='store_true',
+            help='Exit once the queue is empty',
+        )
+
+    def handle(self, *args, **options):
+        autodiscover_modules('tasks')
+        # Процессы пула создаются форком: открытые соединения с БД
+        # не должны достаться им по наследству.
+        connections.close_all()
+        workers = options['workers']
+        client = blocking_client()
+        self.pending = {}
+        self.stdout.write(f'Running tasks with {workers} workers')
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            try:
+                while True:
+                    promote_delayed(client)
+                    if len(self.pending) >= workers:
+                        wait(self.pending, timeout=1,
+                             return_when=FIRST_COMPLETED)
+                        self.collect(client)
+                        continue
+                    item = client.brpop(QUEUE_KEY, timeout=1)
+                    if item is not None:
+                        message = json.loads(item[1])
+                        # Ждущий call мог не дождаться и выполнить сам.
+                        if claim(message):
+                            self.pending[
+                                pool.submit(run_pooled, message)
+                            ] = message
+                    self.collect(client)
+                    if (item is None and options['burst']
+                            and not self.pending):
+                        break
+            except KeyboardInterrupt:
+                self.stdout.write('Waiting for running tasks...')
+                wait(self.pending)
+                self.collect(client)
+
+    def collect(self, client):
+        for future in [future for future in self.pending if future.done()]:
+            message = self.pending.pop(future)
+            try:
+                ok, elapsed_ms, _ = future.result()
+            except Exception:
+                # Процесс пула упал, не вернув результат.
+                ok, elapsed_ms = False, 0.0
+            record_result(client, message, ok, elapsed_ms)
@@ -1,26 +1,52 @@
-from django.core.cache import cache
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination, PageNumberPagination
 
 
 class CustomPagination(PageNumberPagination):
     page_size = 10
     page_size_query_param = 'limit'
 
-    def paginate_queryset(self, queryset, request, view=None):
-        cache_key = f"paginated_{request.path}_{request.query_params}"
-        cached_data = cache.get(cache_key)
-        if cached_data:
-            self.page = cached_data['page']
-            self.request = request
-            return self.page.object_list
-        page = super().paginate_queryset(queryset, request, view)
-        if page is not None:
-            cache.set(cache_key, {
-                'page': self.page,
-            }, timeout=60 * 5)
-        return page
-
-    def get_paginated_response(self, data):
-        if not hasattr(self, 'page'):
-            return super().get_paginated_response(data)
-        return super().get_paginated_response(data)
+
+class RecipeCursorPagination(CursorPagination):
+    page_size = 10
+    page_size_query_param = 'limit'
+    ordering = ('-pub_date', '-id')
+
+
+class UserCursorPagination(CursorPagination):
+    page_size = 10
+    page_size_query_param = 'limit'
+    ordering = ('username', 'id')
+
+
+class CursorPaginationMixin:
+    """Keyset-пагинация по запросу клиента.
+
+    Если в запросе есть параметр ``cursor`` (для первой страницы —
+    пустой), используется ``cursor_pagination_class``: без ``COUNT(*)``
+    и ``OFFSET``, стоимость не зависит от глубины страницы. Иначе —
+    обычная постраничная ``pagination_class``.
+
+    Курсор задаёт свой порядок строк. Параметры из ``cursor_skip_params``
+    сортируют выдачу иначе (например, поиск по релевантности), поэтому
+    с ними ``cursor`` игнорируется и страницы нумеруются как обычно.
+    """
+
+    cursor_pagination_class = None
+    cursor_skip_params = ()
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            pagination_class = self.pagination_class
+            cursor_class = self.cursor_pagination_class
+            params = self.request.query_params
+            if (cursor_class is not None
+                    and cursor_class.cursor_query_param in params
+                    and not any(
+                        param in params for param in self.cursor_skip_params
+                    )):
+                pagination_class = cursor_class
+            self._paginator = (
+                pagination_class() if pagination_class else None
+            )
+        return self._paginator
@@ -0,0 +1,170 @@
+import re
+
+from core.cache import get_or_compute
+from core.counters import get_counters
+from django.conf import settings
+from django.http import HttpResponse
+from recipes.models import Recipe
+from rest_framework.renderers import JSONRenderer
+from users.models import User
+
+from .viewer_state import FOLLOWING, ViewerState
+
+# Флаги зрителя в шаблоне ответа: строка с NUL по краям. NUL не может
+# прийти из данных (PostgreSQL не хранит его в text), а JSONRenderer
+# экранирует его как \u0000.
+SLOT = '\x00{}:{}\x00'
+SLOT_PATTERN = re.compile(rb'"\\u0000(\w+):(\d+)\\u0000"')
+# Счётчики меняются от действий любого зрителя, поэтому в шаблоне они
+# тоже метки: иначе каждое избранное сбрасывало бы все общие шаблоны.
+COUNTER_FIELDS = {
+    Recipe: ('favorites_count', 'in_carts_count'),
+    User: ('recipes_count', 'followers_count'),
+}
+COUNTER_MODELS = {
+    field: model
+    for model, fields in COUNTER_FIELDS.items() for field in fields
+}
+
+
+class TemplateViewerState(ViewerState):
+    """Вместо флагов и счётчиков подставляет метки для замены."""
+
+    def __init__(self):
+        super().__init__(None)
+
+    def prime(self, recipe_ids=(), author_ids=()):
+        pass
+
+    def flag(self, kind, pk):
+        return SLOT.format(kind, pk)
+
+    def counter(self, obj, field):
+        return SLOT.format(field, obj.pk)
+
+    def mark(self, recipe, favorited=False, in_shopping_cart=False):
+        pass
+
+
+class ResponseTemplate:
+    """Готовый JSON ответа, общий для всех зрителей.
+
+    Байты хранятся кусками между метками; для ответа куски склеиваются
+    с true/false, вычисленными для конкретного зрителя, и с текущими
+    значениями счётчиков.
+    """
+
+    def __init__(self, data):
+        content = JSONRenderer().render(data)
+        self.chunks = []
+        self.slots = []
+        position = 0
+        for match in SLOT_PATTERN.finditer(content):
+            self.chunks.append(content[position:match.start()])
+            self.slots.append((match[1].decode(), int(match[2])))
+            position = match.end()
+        self.chunks.append(content[position:])
+
+    def render(self, viewer_state):
+        flags = [slot for slot in self.slots if slot[0] not in COUNTER_MODELS]
+        viewer_state.prime(
+            recipe_ids={pk for kind, pk in flags if kind != FOLLOWING},
+            author_ids={pk for kind, pk in flags if kind == FOLLOWING},
+        )
+        counters = self._counters()
+        parts = [self.chunks[0]]
+        for (kind, pk), chunk in zip(self.slots, self.chunks[1:]):
+            model = COUNTER_MODELS.get(kind)
+            if model is not None:
+                value = counters.get((model, pk), {}).get(kind, 0)
+                parts.append(str(value).encode())
+            else:
+                parts.append(
+                    b'true' if viewer_state.flag(kind, pk) else b'false'
+                )
+            parts.append(chunk)
+        return b''.join(parts)
+
+    def _counters(self):
+        ids_by_model = {}
+        for kind, pk in self.slots:
+            if kind in COUNTER_MODELS:
+                ids_by_model.setdefault(COUNTER_MODELS[kind], set()).add(pk)
+        if not ids_by_model:
+            return {}
+        return get_counters(ids_by_model, COUNTER_FIELDS)
+
+
+class UncacheableResponseError(Exception):
+    """Ответ не 200: отдаётся как есть и в кеш не попадает."""
+
+    def __init__(self, response):
+        super().__init__(response.status_code)
+        self.response = response
+
+
+class ResponseCacheMixin:
+    """Кеш готовых JSON-ответов с подстановкой флагов зрителя.
+
+    Попадание в кеш: чтение поколения и шаблона (get_or_compute),
+    проверка флагов зрителя и счётчики из их кеша, без ORM-запросов
+    страницы и сериализаторов.
+    Параметры из ``response_cache_skip_params`` меняют сам набор строк
+    в зависимости от зрителя, такие запросы не кешируются.
+    """
+
+    response_cache_namespace = None
+    response_cache_skip_params = ()
+    response_cache_timeout = settings.CACHE_TTL
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if getattr(self, '_rendering_template', False):
+            context['viewer_state'] = TemplateViewerState()
+        else:
+            context['viewer_state'] = ViewerState(self.request.user)
+        return context
+
+    def list(self, request, *args, **kwargs):
+        if any(
+            param in request.query_params
+            for param in self.response_cache_skip_params
+        ):
+            return super().list(request, *args, **kwargs)
+
+        # Абсолютный URI: в ответе есть абсолютные ссылки на картинки
+        # и страницы.
+        namespace = self.response_cache_namespace
+        return self.cached_response(
+            request,
+            f'{namespace}:{request.build_absolute_uri()}',
+            (namespace,),
+            self.response_cache_timeout,
+            lambda: super(ResponseCacheMixin, self).list(
+                request, *args, **kwargs
+            ),
+        )
+
+    def cached_response(self, request, cache_key, namespaces, timeout,
+                        produce):
+        """Ответ из шаблона в кеше; produce строит его при промахе."""
+        def build_template():
+            self._rendering_template = True
+            try:
+                response = produce()
+            finally:
+                self._rendering_template = False
+            if response.status_code != 200:
+                raise UncacheableResponseError(response)
+            return ResponseTemplate(response.data)
+
+        try:
+            template = get_or_compute(
+                cache_key, build_template, timeout, namespaces
+            )
+        except UncacheableResponseError as error:
+            return error.response
+        return HttpResponse(
+            template.render(ViewerState(request.user)),
+            content_type='application/json',
+        )
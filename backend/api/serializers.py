@@ -0,0 +1,12 @@
+from django.conf import settings
+from rest_framework import serializers
+
+
+class BulkIdsSerializer(serializers.Serializer):
+    """Список id для массовых операций со связями пользователя."""
+
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=settings.BULK_RELATION_MAX_SIZE,
+    )
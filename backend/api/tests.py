@@ -0,0 +1,331 @@
+import json
+
+import fakeredis
+import pytest
+from core.cache import get_generation
+from core.viewer_sets import FAVORITE, FOLLOWING, SET_KEY, SHOPPING_CART
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from recipes.models import Favorite, Recipe, ShoppingCart
+from rest_framework.authtoken.models import Token
+from rest_framework.parsers import JSONParser
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from users.models import Follow, User
+
+from .authentication import (AUTH_FIELDS, TOKEN_KEY, CachedTokenAuthentication,
+                             token_digest)
+from .bulk import (ADDED, NOT_ALLOWED, NOT_FOUND, REMOVED, UNCHANGED,
+                   change_relations, has_changes)
+from .response_cache import SLOT, ResponseTemplate
+from .viewer_state import ViewerState
+
+
+class FakeViewerState:
+    """Флаги зрителя из готового множества (вид, id)."""
+
+    def __init__(self, flags):
+        self.flags = flags
+        self.primed = None
+
+    def prime(self, recipe_ids=(), author_ids=()):
+        self.primed = (set(recipe_ids), set(author_ids))
+
+    def flag(self, kind, pk):
+        return (kind, pk) in self.flags
+
+
+def test_response_template_fills_viewer_flags():
+    template = ResponseTemplate({'results': [
+        {
+            'id': 1,
+            'name': 'Борщ',
+            'is_favorited': SLOT.format(FAVORITE, 1),
+            'is_in_shopping_cart': SLOT.format(SHOPPING_CART, 1),
+            'author': {'id': 7, 'is_subscribed': SLOT.format(FOLLOWING, 7)},
+        },
+        {
+            'id': 2,
+            'name': 'Щи',
+            'is_favorited': SLOT.format(FAVORITE, 2),
+            'is_in_shopping_cart': SLOT.format(SHOPPING_CART, 2),
+            'author': {'id': 7, 'is_subscribed': SLOT.format(FOLLOWING, 7)},
+        },
+    ]})
+    viewer_state = FakeViewerState({
+        (FAVORITE, 2), (SHOPPING_CART, 1), (FOLLOWING, 7),
+    })
+
+    data = json.loads(template.render(viewer_state))
+
+    assert viewer_state.primed == ({1, 2}, {7})
+    first, second = data['results']
+    assert first == {
+        'id': 1,
+        'name': 'Борщ',
+        'is_favorited': False,
+        'is_in_shopping_cart': True,
+        'author': {'id': 7, 'is_subscribed': True},
+    }
+    assert (second['is_favorited'], second['is_in_shopping_cart']) == (
+        True, False
+    )
+
+
+def test_response_template_keeps_text_without_slots():
+    template = ResponseTemplate({'text': 'favorite:1', 'count': 0})
+    assert template.slots == []
+    assert json.loads(template.render(FakeViewerState(set()))) == {
+        'text': 'favorite:1', 'count': 0,
+    }
+
+
+def test_response_template_fills_counters(make_user, make_recipe):
+    author = make_user('author')
+    recipe = make_recipe('Борщ', author=author)
+    Recipe.objects.filter(pk=recipe.pk).update(favorites_count=3)
+    template = ResponseTemplate({
+        'favorites_count': SLOT.format('favorites_count', recipe.pk),
+        'author': {
+            'followers_count': SLOT.format('followers_count', author.pk),
+        },
+    })
+    assert json.loads(template.render(FakeViewerState(set()))) == {
+        'favorites_count': 3, 'author': {'followers_count': 0},
+    }
+
+
+@pytest.mark.django_db
+def test_favorite_keeps_shared_list_template(
+    make_user, make_recipe, django_capture_on_commit_callbacks
+):
+    recipe, fan = make_recipe('Борщ'), make_user('fan')
+    client = APIClient()
+    first = client.get('/api/recipes/')
+    key = 'recipes:http://testserver/api/recipes/'
+    _, generations, expires_at, *_ = cache.get(key)
+    generation = get_generation('recipes')
+
+    with django_capture_on_commit_callbacks(execute=True):
+        Favorite.objects.add_many(fan.pk, [recipe.pk])
+
+    assert get_generation('recipes') == generation
+    response = client.get('/api/recipes/', HTTP_IF_NONE_MATCH=first['ETag'])
+    # Счётчик в ответе изменился, значит и ETag тоже.
+    assert response.status_code == 200
+    assert response['ETag'] != first['ETag']
+    # Шаблон тот же, а счётчик подставлен свежий.
+    assert cache.get(key)[1:3] == (generations, expires_at)
+    assert response.json()['results'][0]['favorites_count'] == 1
+
+
+def relation_request(method, user, ids):
+    django_request = getattr(APIRequestFactory(), method)(
+        '/', {'ids': ids}, format='json'
+    )
+    request = Request(django_request, parsers=[JSONParser()])
+    request.user = user
+    return request
+
+
+@pytest.mark.django_db
+def test_change_relations_statuses(make_user, make_recipe):
+    user = make_user('viewer')
+    first, second = make_recipe('first'), make_recipe('second')
+    missing = second.pk + 1000
+
+    results = change_relations(
+        relation_request('post', user, [first.pk, second.pk, missing]),
+        Favorite.objects, Recipe,
+    )
+    assert results == [
+        {'id': first.pk, 'status': ADDED},
+        {'id': second.pk, 'status': ADDED},
+        {'id': missing, 'status': NOT_FOUND},
+    ]
+    assert has_changes(results)
+
+    results = change_relations(
+        relation_request('post', user, [first.pk, first.pk]),
+        Favorite.objects, Recipe,
+    )
+    assert results == [{'id': first.pk, 'status': UNCHANGED}]
+    assert not has_changes(results)
+
+    results = change_relations(
+        relation_request('delete', user, [first.pk, missing]),
+        Favorite.objects, Recipe,
+    )
+    assert results == [
+        {'id': first.pk, 'status': REMOVED},
+        {'id': missing, 'status': NOT_FOUND},
+    ]
+    assert list(
+        Favorite.objects.filter(user=user).values_list('recipe', flat=True)
+    ) == [second.pk]
+    first.refresh_from_db()
+    second.refresh_from_db()
+    assert (first.favorites_count, second.favorites_count) == (0, 1)
+
+
+@pytest.mark.django_db
+def test_change_relations_forbidden(make_user):
+    user, author = make_user('viewer'), make_user('author')
+    results = change_relations(
+        relation_request('post', user, [user.pk, author.pk]),
+        Follow.objects, User, forbidden={user.pk},
+    )
+    assert results == [
+        {'id': user.pk, 'status': NOT_ALLOWED},
+        {'id': author.pk, 'status': ADDED},
+    ]
+    assert not Follow.objects.filter(user=user, following=user).exists()
+    author.refresh_from_db()
+    assert author.followers_count == 1
+
+
+@pytest.fixture
+def token_client(make_user):
+    user = make_user('viewer')
+    token = Token.objects.create(user=user)
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+    assert client.get('/api/users/me/').status_code == 200
+    assert cache.get(TOKEN_KEY.format(token_digest(token.key))) is not None
+    return client, user, token
+
+
+def log_out(client, user):
+    assert client.post('/api/auth/token/logout/').status_code == 204
+
+
+def change_password(client, user):
+    assert client.post('/api/users/set_password/', {
+        'current_password': 'password', 'new_password': 'new-password',
+    }).status_code == 204
+
+
+def deactivate(client, user):
+    user.is_active = False
+    user.save()
+
+
+def delete_user(client, user):
+    user.delete()
+
+
+@pytest.mark.parametrize(
+    'revoke', [log_out, change_password, deactivate, delete_user]
+)
+def test_cached_token_stops_working(token_client, revoke):
+    client, user, token = token_client
+    revoke(client, user)
+    assert cache.get(TOKEN_KEY.format(token_digest(token.key))) is None
+    assert client.get('/api/users/me/').status_code == 401
+
+
+def test_cached_token_survives_login(
+    token_client, django_assert_num_queries
+):
+    client, user, token = token_client
+    user.last_login = timezone.now()
+    user.save(update_fields=['last_login'])
+
+    fields = cache.get(TOKEN_KEY.format(token_digest(token.key)))
+    assert set(fields) == set(AUTH_FIELDS)
+    with django_assert_num_queries(0):
+        cached_user, _ = CachedTokenAuthentication().authenticate_credentials(
+            token.key
+        )
+    assert cached_user.pk == user.pk
+    # Пароль и счётчики не из кеша: они отложены до обращения.
+    assert {'password', 'recipes_count', 'followers_count'} <= (
+        cached_user.get_deferred_fields()
+    )
+
+
+def test_favorite_reads_recipe_once(make_user, make_recipe):
+    recipe, user = make_recipe('Борщ'), make_user('viewer')
+    client = APIClient()
+    client.force_authenticate(user)
+    url = f'/api/recipes/{recipe.pk}/favorite/'
+
+    with CaptureQueriesContext(connection) as context:
+        response = client.post(url)
+    assert response.status_code == 201
+    assert response.json()['name'] == 'Борщ'
+    statements = [
+        sql for sql in (
+            query['sql'].strip() for query in context.captured_queries
+        )
+        if sql.startswith('INSERT')
+        or sql.startswith('SELECT') and 'FROM "recipes_recipe"' in sql
+    ]
+    # Поля ответа - одним SELECT до INSERT, без описания рецепта.
+    assert len(statements) == 2
+    select, insert = statements
+    assert select.startswith('SELECT') and insert.startswith('INSERT')
+    assert '"recipes_recipe"."text"' not in select
+    assert client.post(url).status_code == 400
+    assert client.post(
+        f'/api/recipes/{recipe.pk + 1000}/favorite/'
+    ).status_code == 404
+
+
+@pytest.fixture
+def redis_server(settings, monkeypatch):
+    """Кеш django_redis на fakeredis: множества зрителя живут в Redis."""
+    server = fakeredis.FakeServer()
+    settings.CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': 'redis://fakeredis/1',
+            'OPTIONS': {
+                'CONNECTION_POOL_KWARGS': {
+                    'connection_class': fakeredis.FakeConnection,
+                    'server': server,
+                },
+            },
+        },
+    }
+    monkeypatch.setattr('core.viewer_sets.redis_available', lambda: True)
+    return fakeredis.FakeRedis(server=server, db=1)
+
+
+def viewer_flags(user, recipe_ids, author_ids):
+    state = ViewerState(user)
+    state.prime(recipe_ids=recipe_ids, author_ids=author_ids)
+    return (
+        {pk for pk in recipe_ids if state.flag(FAVORITE, pk)},
+        {pk for pk in recipe_ids if state.flag(SHOPPING_CART, pk)},
+        {pk for pk in author_ids if state.flag(FOLLOWING, pk)},
+    )
+
+
+def test_viewer_state_follows_changes_through_redis_sets(
+    redis_server, make_user, make_recipe, django_assert_num_queries,
+    django_capture_on_commit_callbacks
+):
+    viewer, author = make_user('viewer'), make_user('author')
+    soup, cake = make_recipe('soup', author), make_recipe('cake', author)
+    recipe_ids, author_ids = [soup.pk, cake.pk], [author.pk]
+    with django_capture_on_commit_callbacks(execute=True):
+        Favorite.objects.add_many(viewer.pk, [soup.pk])
+
+    # Множества грузятся из БД один раз, дальше - только SMISMEMBER.
+    assert viewer_flags(viewer, recipe_ids, author_ids) == (
+        {soup.pk}, set(), set()
+    )
+    assert redis_server.exists(SET_KEY.format(viewer.pk, FAVORITE))
+
+    with django_capture_on_commit_callbacks(execute=True):
+        Favorite.objects.remove_many(viewer.pk, [soup.pk])
+        ShoppingCart.objects.add_many(viewer.pk, [cake.pk])
+        Follow.objects.add_many(viewer.pk, [author.pk])
+
+    with django_assert_num_queries(0):
+        assert viewer_flags(viewer, recipe_ids, author_ids) == (
+            set(), {cake.pk}, {author.pk}
+        )
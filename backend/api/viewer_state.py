@@ -0,0 +1,149 @@
+from core import viewer_sets
+from core.viewer_sets import FAVORITE, FOLLOWING, SHOPPING_CART
+from django.db.models import CharField, Exists, OuterRef, Value
+from recipes.models import Favorite, ShoppingCart
+from rest_framework import serializers
+from users.models import Follow
+
+RELATIONS = {
+    FAVORITE: (Favorite, 'recipe_id'),
+    SHOPPING_CART: (ShoppingCart, 'recipe_id'),
+    FOLLOWING: (Follow, 'following_id'),
+}
+
+
+class ViewerState:
+    """Отношения текущего пользователя к рецептам и авторам страницы.
+
+    Флаги «в избранном», «в списке покупок» и «подписан» проверяются
+    пачкой для всех рецептов и авторов страницы: SMISMEMBER по
+    множествам зрителя в Redis (core.viewer_sets), а без Redis - одним
+    запросом к БД, а не запросом на каждую строку.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self._resolved = {FAVORITE: {}, SHOPPING_CART: {}, FOLLOWING: {}}
+
+    @property
+    def is_authenticated(self):
+        return bool(self.user and self.user.is_authenticated)
+
+    def prime(self, recipe_ids=(), author_ids=()):
+        """Загрузить флаги для ещё не известных объектов."""
+        recipe_ids = self._unresolved((FAVORITE, SHOPPING_CART), recipe_ids)
+        author_ids = self._unresolved((FOLLOWING,), author_ids)
+        if not self.is_authenticated or not (recipe_ids or author_ids):
+            return
+
+        ids_by_kind = {
+            FAVORITE: recipe_ids,
+            SHOPPING_CART: recipe_ids,
+            FOLLOWING: author_ids,
+        }
+        found = viewer_sets.members(
+            self.user.pk, ids_by_kind,
+            {kind: self._loader(kind) for kind in RELATIONS},
+        )
+        if found is None:
+            found = self._query(ids_by_kind)
+        for kind, ids in found.items():
+            self._resolved[kind].update(dict.fromkeys(ids, True))
+
+    def _loader(self, kind):
+        model, field = RELATIONS[kind]
+        return lambda: model.objects.filter(
+            user=self.user
+        ).values_list(field, flat=True).order_by()
+
+    def _query(self, ids_by_kind):
+        """Флаги из БД одним запросом, когда Redis недоступен."""
+        querysets = [
+            self._relation_rows(*RELATIONS[kind], kind, ids)
+            for kind, ids in ids_by_kind.items() if ids
+        ]
+        first, *rest = querysets
+        rows = first.union(*rest, all=True) if rest else first
+        found = {kind: set() for kind in ids_by_kind}
+        for kind, pk in rows:
+            found[kind].add(pk)
+        return found
+
+    def _unresolved(self, kinds, ids):
+        resolved = self._resolved[kinds[0]]
+        missing = {pk for pk in ids if pk not in resolved}
+        for kind in kinds:
+            self._resolved[kind].update(dict.fromkeys(missing, False))
+        return missing
+
+    def _relation_rows(self, model, field, kind, ids):
+        return model.objects.filter(
+            user=self.user, **{f'{field}__in': ids}
+        ).annotate(
+            kind=Value(kind, output_field=CharField())
+        ).values_list('kind', field).order_by()
+
+    def flag(self, kind, pk):
+        """Флаг отношения kind к рецепту или автору с данным pk."""
+        if kind == FOLLOWING:
+            self.prime(author_ids=[pk])
+        else:
+            self.prime(recipe_ids=[pk])
+        return self._resolved[kind][pk]
+
+    def is_favorited(self, recipe):
+        return self.flag(FAVORITE, recipe.id)
+
+    def is_in_shopping_cart(self, recipe):
+        return self.flag(SHOPPING_CART, recipe.id)
+
+    def is_subscribed(self, author):
+        return self.flag(FOLLOWING, author.id)
+
+    def counter(self, obj, field):
+        """Счётчик объекта; в шаблоне ответа вместо него метка."""
+        return getattr(obj, field)
+
+    def mark(self, recipe, favorited=False, in_shopping_cart=False):
+        """Запомнить известные заранее флаги, например для нового рецепта."""
+        self._resolved[FAVORITE][recipe.id] = favorited
+        self._resolved[SHOPPING_CART][recipe.id] = in_shopping_cart
+
+    def filter_favorited(self, queryset):
+        return self._filter_related(queryset, Favorite)
+
+    def filter_in_shopping_cart(self, queryset):
+        return self._filter_related(queryset, ShoppingCart)
+
+    def _filter_related(self, queryset, model):
+        if not self.is_authenticated:
+            return queryset
+        return queryset.filter(Exists(model.objects.filter(
+            user=self.user, recipe=OuterRef('pk')
+        )))
+
+
+def get_viewer_state(context):
+    """Состояние зрителя, общее для всех сериализаторов одного запроса."""
+    state = context.get('viewer_state')
+    if state is None:
+        request = context.get('request')
+        state = ViewerState(getattr(request, 'user', None))
+        context['viewer_state'] = state
+    return state
+
+
+class CounterField(serializers.Field):
+    """Счётчик из строки модели, например favorites_count.
+
+    В общем шаблоне ответа (api.response_cache) это метка: значение
+    подставляется при отдаче, и шаблон не зависит от действий зрителей.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(source='*', read_only=True, **kwargs)
+
+    def to_representation(self, instance):
+        return get_viewer_state(self.context).counter(
+            instance, self.field_name
+        )
@@ -0,0 +1,94 @@
+import threading
+from collections import defaultdict, deque
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def local_cache(settings, monkeypatch):
+    """Кеш в памяти процесса вместо Redis: тестам не нужен сервер."""
+    from api.authentication import _local_tokens
+    from core.cache import tiered_cache
+    from foodgram_api.images import _local_ready
+
+    settings.CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+    tiered_cache.local.clear()
+    _local_ready.clear()
+    _local_tokens.clear()
+    # Статистика уходит в Redis напрямую, в тестах её не сбрасываем.
+    monkeypatch.setattr(tiered_cache, 'stats_interval', float('inf'))
+    # Множества зрителей живут только в Redis: флаги берутся из БД.
+    monkeypatch.setattr('core.viewer_sets.redis_available', lambda: False)
+    yield
+    from django.core.cache import cache
+    cache.clear()
+
+
+@pytest.fixture
+def make_user(db):
+    from users.models import User
+
+    def make_user(username):
+        return User.objects.create_user(
+            username=username, email=f'{username}@example.com',
+            password='password', first_name=username, last_name=username,
+        )
+    return make_user
+
+
+@pytest.fixture
+def make_recipe(db, make_user):
+    from recipes.models import Recipe
+
+    def make_recipe(name, author=None):
+        return Recipe.objects.create(
+            author=author or make_user(f'author-{name}'),
+            name=name, text=name, cooking_time=10, image='recipes/x.png',
+        )
+    return make_recipe
+
+
+class FakeRedisLists:
+    """Списки Redis в памяти процесса: RPUSH и блокирующий BLPOP."""
+
+    def __init__(self):
+        self.lists = defaultdict(deque)
+        self._changed = threading.Condition()
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        pass
+
+    def rpush(self, key, value):
+        with self._changed:
+            self.lists[key].append(value)
+            self._changed.notify_all()
+
+    def expire(self, key, seconds):
+        pass
+
+    def blpop(self, key, timeout):
+        with self._changed:
+            if not self._changed.wait_for(lambda: self.lists[key], timeout):
+                return None
+            return key, self.lists[key].popleft()
+
+
+@pytest.fixture
+def task_queue(settings, monkeypatch):
+    """Очередь задач в списке; воркеров нет, пока тест их не запустит."""
+    settings.TASKS_EAGER = False
+    messages = []
+    monkeypatch.setattr('core.tasks.enqueue', messages.append)
+    results = FakeRedisLists()
+    monkeypatch.setattr('core.tasks.blocking_client', lambda: results)
+    monkeypatch.setattr(
+        'core.tasks.get_redis_connection', lambda alias: results
+    )
+    return messages
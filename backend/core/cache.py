@@ -0,0 +1,274 @@
+import logging
+import math
+import pickle
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from .local_cache import LocalLRUCache
+
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = 'generation:{}'
+STATS_KEY = 'foodgram:cache:stats'
+# Записи get_or_compute: (значение, поколения, срок, время расчёта,
+# размер значения); ENTRY_SIZE - индекс размера.
+ENTRY_SIZE = 4
+# Блокировку снимает только её владелец: за время долгого расчёта она
+# могла истечь и достаться другому процессу.
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def redis_available():
+    """False, пока кеш работает на локальном резерве (ResilientRedisCache)."""
+    return not getattr(cache, 'is_degraded', False)
+
+
+def after_cache_recovery(action):
+    """Выполнить action(client) в Redis после восстановления кеша."""
+    after_recovery = getattr(cache, 'after_recovery', None)
+    if after_recovery is not None:
+        after_recovery(action)
+
+
+def get_generation(namespace):
+    """Текущее поколение пространства имён кеша."""
+    key = GENERATION_KEY.format(namespace)
+    generation = cache.get(key)
+    if generation is not None:
+        return generation
+    # Начальное значение берём от времени, чтобы после вытеснения
+    # счётчика не вернуться к уже использованному поколению.
+    cache.add(key, time.time_ns() // 1000, timeout=None)
+    return cache.get(key)
+
+
+def get_generations(*namespaces):
+    """Поколения нескольких пространств имён за одно обращение к кешу."""
+    keys = [GENERATION_KEY.format(namespace) for namespace in namespaces]
+    found = cache.get_many(keys)
+    return [
+        found[key] if key in found else get_generation(namespace)
+        for key, namespace in zip(keys, namespaces)
+    ]
+
+
+def bump_generation(namespace):
+    """Инвалидировать все ключи пространства имён за O(1).
+
+    Старые ключи не удаляются, а перестают читаться и истекают по TTL.
+    """
+    key = GENERATION_KEY.format(namespace)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.add(key, time.time_ns() // 1000, timeout=None)
+        return cache.get(key)
+
+
+def bump_generations_on_commit(*namespaces):
+    """Сдвинуть поколения после коммита текущей транзакции.
+
+    Сдвиг до коммита даёт читателю новое поколение при старых данных в
+    БД: он сохранил бы устаревшее значение под новым поколением.
+    """
+    def bump():
+        for namespace in namespaces:
+            bump_generation(namespace)
+
+    transaction.on_commit(bump)
+
+
+class TieredCache:
+    """Кеш в памяти процесса перед общим кешем Redis.
+
+    Хранит записи get_or_compute под стабильными ключами. Свежесть
+    проверяет get_or_compute: поколения в записи сравниваются с
+    текущими, которые читаются из Redis одним маленьким запросом, а
+    отставшая от другого воркера запись перечитывается (reload). Так
+    крупное значение не передаётся по сети и не распаковывается, пока
+    оно свежее. Значения локального уровня общие для запросов процесса,
+    их нельзя изменять. Размер для лимита берётся из записи, а не
+    сериализацией при каждом копировании.
+
+    Попадания в память, в Redis и промахи считаются по пространству
+    имён (начало ключа до двоеточия) и периодически сбрасываются в хеш
+    STATS_KEY (см. команду cache_stats).
+    """
+
+    def __init__(self, max_items, max_bytes, ttl, stats_interval):
+        self.local = LocalLRUCache(max_items, ttl, max_bytes=max_bytes)
+        self.stats_interval = stats_interval
+        self._stats = Counter()
+        self._stats_lock = threading.Lock()
+        self._flushed_at = time.monotonic()
+
+    def get(self, key):
+        namespace = key.partition(':')[0]
+        value = self.local.get(key)
+        if value is not None:
+            self._count(namespace, 'local')
+            return value
+        value = cache.get(key)
+        if value is None:
+            self._count(namespace, 'miss')
+            return None
+        self._count(namespace, 'redis')
+        self.local.set(key, value, self._size(value))
+        return value
+
+    def set(self, key, value, timeout):
+        cache.set(key, value, timeout)
+        self.local.set(key, value, self._size(value), ttl=timeout)
+
+    def reload(self, key):
+        """Прочитать ключ из Redis мимо локального уровня и обновить его."""
+        value = cache.get(key)
+        if value is not None:
+            self.local.set(key, value, self._size(value))
+        return value
+
+    def _size(self, entry):
+        # Размер посчитан один раз при расчёте записи (см. _compute).
+        return entry[ENTRY_SIZE] if len(entry) > ENTRY_SIZE else 0
+
+    def _count(self, namespace, outcome):
+        with self._stats_lock:
+            self._stats[f'{namespace}:{outcome}'] += 1
+            if (time.monotonic() - self._flushed_at < self.stats_interval
+                    or not redis_available()):
+                return
+            stats, self._stats = self._stats, Counter()
+            self._flushed_at = time.monotonic()
+        try:
+            pipe = get_redis_connection('default').pipeline(transaction=False)
+            for field, count in stats.items():
+                pipe.hincrby(STATS_KEY, field, count)
+            pipe.execute()
+        except RedisError:
+            logger.warning('Cache stats flush failed', exc_info=True)
+
+
+tiered_cache = TieredCache(
+    settings.LOCAL_CACHE_MAX_ITEMS,
+    settings.LOCAL_CACHE_MAX_BYTES,
+    settings.LOCAL_CACHE_TTL,
+    settings.CACHE_STATS_INTERVAL,
+)
+
+
+def get_or_compute(key, compute, timeout, namespaces=(), local=True):
+    """Значение из кеша или compute(), без лавины пересчётов.
+
+    Запись хранит значение вместе с поколениями ``namespaces`` на момент
+    начала расчёта, поэтому ключ стабилен, а сдвиг поколения делает её
+    устаревшей, но не удаляет:
+
+    * пересчитывает только тот, кто взял блокировку ``lock:<key>``;
+      остальные в течение CACHE_STALE_TTL отдают устаревшее значение,
+      а без него ждут результат до CACHE_LOCK_WAIT секунд;
+    * незадолго до истечения TTL запись пересчитывается заранее с
+      вероятностью, растущей к концу срока и со временем расчёта
+      (XFetch), чтобы горячий ключ не истекал у всех разом.
+
+    local=False - только Redis, без локального уровня (фоновые задачи).
+    """
+    store = tiered_cache if local else cache
+    generations = get_generations(*namespaces)
+    entry = store.get(key)
+    if local and not _is_fresh(entry, generations):
+        # Локальная копия могла отстать от пересчёта в другом воркере.
+        entry = tiered_cache.reload(key)
+    if _is_fresh(entry, generations) and not _recompute_early(entry):
+        return entry[0]
+
+    stale = entry is not None and (
+        time.time() < entry[2] + settings.CACHE_STALE_TTL
+    )
+    lock_key = f'lock:{key}'
+    token = uuid.uuid4().hex
+    if cache.add(lock_key, token, settings.CACHE_LOCK_TIMEOUT):
+        try:
+            return _compute(store, key, compute, timeout, generations)
+        finally:
+            _release_lock(lock_key, token)
+    if stale:
+        return entry[0]
+
+    deadline = time.monotonic() + settings.CACHE_LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        entry = cache.get(key)
+        if _is_fresh(entry, generations):
+            return entry[0]
+    logger.warning('Gave up waiting for %s, computing it again', key)
+    return _compute(store, key, compute, timeout, generations)
+
+
+def _release_lock(lock_key, token):
+    """Удалить блокировку, если в ней всё ещё token."""
+    client = getattr(cache, 'client', None)
+    if client is None or not redis_available():
+        # Кеш процесса (тесты, резерв без Redis): удаление мимо
+        # ResilientRedisCache, чтобы его не повторили в Redis.
+        local = getattr(cache, 'fallback', cache)
+        if local.get(lock_key) == token:
+            local.delete(lock_key)
+        return
+    try:
+        client.get_client().eval(
+            _RELEASE_LOCK_SCRIPT, 1,
+            client.make_key(lock_key), client.encode(token),
+        )
+    except RedisError:
+        # Блокировка истечёт сама через CACHE_LOCK_TIMEOUT.
+        logger.warning('Failed to release %s', lock_key, exc_info=True)
+
+
+def _is_fresh(entry, generations):
+    return (
+        entry is not None
+        and len(entry) > ENTRY_SIZE
+        and entry[1] == generations
+        and time.time() < entry[2]
+    )
+
+
+def _recompute_early(entry):
+    _, _, expires_at, delta, _ = entry
+    # 1 - random() лежит в (0, 1], логарифм от него не падает.
+    return time.time() - delta * settings.CACHE_XFETCH_BETA * math.log(
+        1 - random.random()
+    ) >= expires_at
+
+
+def _compute(store, key, compute, timeout, generations):
+    start = time.monotonic()
+    value = compute()
+    delta = time.monotonic() - start
+    store.set(
+        key,
+        (value, generations, time.time() + timeout, delta, _size(value)),
+        timeout + settings.CACHE_STALE_TTL,
+    )
+    return value
+
+
+def _size(value):
+    """Размер значения для лимита LOCAL_CACHE_MAX_BYTES."""
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
@@ -0,0 +1,227 @@
+import logging
+import threading
+import time
+from collections import deque
+
+from django.core.cache.backends.locmem import LocMemCache
+from django_redis.cache import RedisCache
+from django_redis.exceptions import ConnectionInterrupted
+from redis.exceptions import ConnectionError, TimeoutError
+
+from .cache import STATS_KEY
+
+logger = logging.getLogger(__name__)
+
+UNAVAILABLE = (ConnectionError, TimeoutError, ConnectionInterrupted)
+
+
+class CircuitBreaker:
+    """Размыкается после нескольких ошибок подряд, пробует снова позже.
+
+    Пока цепь разомкнута, вызовы к Redis не делаются вовсе, поэтому
+    недоступный Redis не стоит каждому запросу таймаута соединения.
+    Раз в reset_timeout проверку делает один вызов (полуоткрытое
+    состояние), остальные до её итога работают без Redis.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.retry_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """Можно ли обращаться к Redis: цепь замкнута или это проба."""
+        if self.opened_at is None:
+            return True
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            now = time.monotonic()
+            if now < self.retry_at:
+                return False
+            # Проба занята этим вызовом; следующая - через период.
+            self.retry_at = now + self.reset_timeout
+            return True
+
+    def success(self):
+        """Отметить успех; вернуть время простоя, если цепь замкнулась."""
+        with self._lock:
+            self.failures = 0
+            opened_at, self.opened_at = self.opened_at, None
+        if opened_at is None:
+            return None
+        return time.monotonic() - opened_at
+
+    def failure(self):
+        """Отметить ошибку; вернуть True, если цепь только что разомкнулась."""
+        with self._lock:
+            self.failures += 1
+            now = time.monotonic()
+            if self.opened_at is not None:
+                # Пробный вызов не удался: ждём следующего периода.
+                self.retry_at = now + self.reset_timeout
+                return False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = now
+                self.retry_at = now + self.reset_timeout
+                return True
+            return False
+
+
+class ResilientRedisCache(RedisCache):
+    """django_redis с переходом на локальный кеш, когда Redis недоступен.
+
+    Ошибки соединения размыкают CircuitBreaker, и до его проверки кеш
+    работает на ограниченном LocMemCache процесса. Удаления ключей и
+    сдвиги поколений, сделанные в это время, запоминаются и повторяются
+    в Redis после восстановления, чтобы там не остались устаревшие
+    данные. Состояние видно в ``degraded_stats`` и в хеше STATS_KEY.
+
+    Дополнительные OPTIONS: FAILURE_THRESHOLD, RESET_TIMEOUT,
+    FALLBACK_MAX_ENTRIES, MAX_REPLAY.
+    """
+
+    def __init__(self, server, params):
+        super().__init__(server, params)
+        options = params.get('OPTIONS', {})
+        self.breaker = CircuitBreaker(
+            options.get('FAILURE_THRESHOLD', 3),
+            options.get('RESET_TIMEOUT', 5),
+        )
+        self.fallback = LocMemCache(f'fallback-{server}', {
+            'TIMEOUT': params.get('TIMEOUT', 300),
+            'KEY_PREFIX': params.get('KEY_PREFIX', ''),
+            'OPTIONS': {
+                'MAX_ENTRIES': options.get('FALLBACK_MAX_ENTRIES', 5000),
+            },
+        })
+        self._replay = deque(maxlen=options.get('MAX_REPLAY', 10000))
+        self.degraded_stats = {'outages': 0, 'fallback_calls': 0}
+
+    @property
+    def is_degraded(self):
+        return self.breaker.is_open
+
+    def after_recovery(self, action):
+        """Выполнить action(client) в Redis, когда он снова станет доступен."""
+        if len(self._replay) == self._replay.maxlen:
+            logger.error('Cache replay queue is full, dropping oldest action')
+        self._replay.append(action)
+
+    def _call(self, method, *args, **kwargs):
+        if self.breaker.allow():
+            try:
+                result = getattr(super(), method)(*args, **kwargs)
+            except UNAVAILABLE:
+                if self.breaker.failure():
+                    self.degraded_stats['outages'] += 1
+                    logger.error('Redis is unavailable, using local cache')
+            else:
+                downtime = self.breaker.success()
+                if downtime is not None:
+                    self._recover(downtime)
+                return result
+        self.degraded_stats['fallback_calls'] += 1
+        return self._fallback_call(method, *args, **kwargs)
+
+    def _fallback_call(self, method, *args, **kwargs):
+        if method in ('delete', 'delete_many', 'incr'):
+            self.after_recovery(
+                lambda client: self._replay_call(method, *args, **kwargs)
+            )
+        if method == 'delete_pattern':
+            self.after_recovery(
+                lambda client: super(ResilientRedisCache, self).delete_pattern(
+                    *args, **kwargs
+                )
+            )
+            return 0
+        if method == 'ttl':
+            return None
+        return getattr(self.fallback, method)(*args, **kwargs)
+
+    def _replay_call(self, method, *args, **kwargs):
+        try:
+            getattr(super(), method)(*args, **kwargs)
+        except ValueError:
+            # incr отсутствующего ключа: поколение создастся заново.
+            pass
+
+    def _recover(self, downtime):
+        logger.warning('Redis is back after %.1f s, replaying %d actions',
+                       downtime, len(self._replay))
+        try:
+            client = self.client.get_client()
+            while self._replay:
+                action = self._replay.popleft()
+                try:
+                    action(client)
+                except UNAVAILABLE:
+                    self._replay.appendleft(action)
+                    raise
+                except Exception:
+                    logger.exception('Cache replay action failed')
+            pipe = client.pipeline(transaction=False)
+            pipe.hincrby(STATS_KEY, 'degraded:outages', 1)
+            pipe.hincrbyfloat(STATS_KEY, 'degraded:seconds', downtime)
+            pipe.hincrby(
+                STATS_KEY, 'degraded:fallback_calls',
+                self.degraded_stats['fallback_calls'],
+            )
+            pipe.execute()
+        except UNAVAILABLE:
+            # Redis снова пропал: остаток повторим при следующем успехе.
+            self.breaker.failure()
+            return
+        self.degraded_stats['fallback_calls'] = 0
+        self.fallback.clear()
+
+    def get(self, *args, **kwargs):
+        return self._call('get', *args, **kwargs)
+
+    def set(self, *args, **kwargs):
+        return self._call('set', *args, **kwargs)
+
+    def add(self, *args, **kwargs):
+        return self._call('add', *args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        return self._call('delete', *args, **kwargs)
+
+    def delete_pattern(self, *args, **kwargs):
+        return self._call('delete_pattern', *args, **kwargs)
+
+    def get_many(self, *args, **kwargs):
+        return self._call('get_many', *args, **kwargs)
+
+    def set_many(self, *args, **kwargs):
+        return self._call('set_many', *args, **kwargs)
+
+    def delete_many(self, *args, **kwargs):
+        return self._call('delete_many', *args, **kwargs)
+
+    def incr(self, *args, **kwargs):
+        return self._call('incr', *args, **kwargs)
+
+    def decr(self, *args, **kwargs):
+        return self._call('decr', *args, **kwargs)
+
+    def has_key(self, *args, **kwargs):
+        return self._call('has_key', *args, **kwargs)
+
+    def touch(self, *args, **kwargs):
+        return self._call('touch', *args, **kwargs)
+
+    def ttl(self, *args, **kwargs):
+        return self._call('ttl', *args, **kwargs)
+
+    def clear(self):
+        self.fallback.clear()
+        return self._call('clear')
@@ -0,0 +1,82 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+
+from .cache import bump_generation
+
+COUNTERS_KEY = 'counters:{}:{}'
+COUNTERS_NAMESPACE = 'counters:{}'
+
+
+def change_counter(queryset, field, delta):
+    """Атомарно изменить счётчик в БД, не опуская его ниже нуля."""
+    return queryset.update(**{field: Greatest(F(field) + delta, Value(0))})
+
+
+def loaded_fields(instance, exclude=()):
+    """update_fields для полного save: загруженные поля, кроме exclude.
+
+    Счётчики меняет только change_counter через F(): значения, прочитанные
+    в начале запроса, затёрли бы чужие изменения.
+    """
+    return [
+        field.attname for field in instance._meta.concrete_fields
+        if not field.primary_key and field.name not in exclude
+        and field.attname in instance.__dict__
+    ]
+
+
+def _counters_key(model, pk):
+    return COUNTERS_KEY.format(model._meta.label_lower, pk)
+
+
+def counters_namespace(model):
+    """Поколение счётчиков модели: для ETag ответов, где они выводятся."""
+    return COUNTERS_NAMESPACE.format(model._meta.label_lower)
+
+
+def get_counters(ids_by_model, fields_by_model):
+    """Счётчики строк: {(модель, pk): {поле: значение}}.
+
+    Все строки читаются из кеша одним get_many, недостающие - одним
+    запросом на модель и кладутся в кеш на COUNTERS_TTL.
+    """
+    keys = {
+        (model, pk): _counters_key(model, pk)
+        for model, ids in ids_by_model.items() for pk in ids
+    }
+    found = cache.get_many(keys.values())
+    counters = {
+        item: found[key] for item, key in keys.items() if key in found
+    }
+    loaded = {}
+    for model, ids in ids_by_model.items():
+        missing = [pk for pk in ids if (model, pk) not in counters]
+        if not missing:
+            continue
+        for row in model.objects.filter(pk__in=missing).values(
+            'pk', *fields_by_model[model]
+        ):
+            pk = row.pop('pk')
+            counters[model, pk] = loaded[keys[model, pk]] = row
+    if loaded:
+        cache.set_many(loaded, settings.COUNTERS_TTL)
+    return counters
+
+
+def forget_counters(model, ids):
+    """Сбросить кеш счётчиков строк после коммита их изменения.
+
+    Заодно сдвигается поколение счётчиков модели, чтобы сменился ETag
+    списков. Чтение, начатое до коммита, может вернуть в кеш старое
+    значение; его ограничивает COUNTERS_TTL.
+    """
+    keys = [_counters_key(model, pk) for pk in ids]
+
+    def forget():
+        cache.delete_many(keys)
+        bump_generation(counters_namespace(model))
+
+    transaction.on_commit(forget)
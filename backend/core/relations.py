@@ -0,0 +1,63 @@
+from django.db import connection, models, transaction
+
+
+class UserRelationManager(models.Manager):
+    """Связи «пользователь - объект» пачкой, одним запросом на изменение.
+
+    INSERT ... ON CONFLICT DO NOTHING и DELETE возвращают id объектов,
+    которые действительно изменились. Сигналы модели при этом не
+    отправляются, поэтому вся сопутствующая работа (счётчики, агрегаты,
+    кеш) делается в ``changed``.
+    """
+
+    target_field = None
+
+    def add_many(self, user_id, target_ids):
+        """Создать связи; вернуть id объектов, для которых они появились."""
+        return self._apply(self._INSERT_SQL, user_id, target_ids, 1)
+
+    def remove_many(self, user_id, target_ids):
+        """Удалить связи; вернуть id объектов, для которых они были."""
+        return self._apply(self._DELETE_SQL, user_id, target_ids, -1)
+
+    def changed(self, user_id, target_ids, delta):
+        """Обновить зависимые данные после изменения связей."""
+
+    def _apply(self, sql, user_id, target_ids, delta):
+        target_ids = list(target_ids)
+        if not target_ids:
+            return []
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(self._format(sql), {
+                    'user': user_id, 'targets': target_ids,
+                })
+                changed_ids = [row[0] for row in cursor.fetchall()]
+            if changed_ids:
+                self.changed(user_id, changed_ids, delta)
+        return changed_ids
+
+    def _format(self, sql):
+        quote = connection.ops.quote_name
+        field = self.model._meta.get_field(self.target_field)
+        return sql.format(
+            table=quote(self.model._meta.db_table),
+            column=quote(field.column),
+            target_table=quote(field.related_model._meta.db_table),
+            target_pk=quote(field.target_field.column),
+        )
+
+    # Несуществующие объекты отсекает JOIN, а не ошибка внешнего ключа.
+    _INSERT_SQL = """
+        INSERT INTO {table} (user_id, {column})
+        SELECT %(user)s, target.{target_pk}
+        FROM {target_table} AS target
+        WHERE target.{target_pk} = ANY(%(targets)s::bigint[])
+        ON CONFLICT DO NOTHING
+        RETURNING {column}
+    """
+    _DELETE_SQL = """
+        DELETE FROM {table}
+        WHERE user_id = %(user)s AND {column} = ANY(%(targets)s::bigint[])
+        RETURNING {column}
+    """
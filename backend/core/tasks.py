@@ -0,0 +1,246 @@
+import json
+import logging
+import pickle
+import time
+import uuid
+from functools import lru_cache
+from importlib import import_module
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django_redis import get_redis_connection
+from redis import ConnectionPool, Redis
+from redis.exceptions import RedisError
+
+from .cache import redis_available
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = 'foodgram:tasks'
+DELAYED_KEY = 'foodgram:tasks:delayed'
+STATS_KEY = 'foodgram:tasks:stats'
+RESULT_KEY = 'foodgram:tasks:result:{}'
+CLAIM_KEY = 'task_claim:{}'
+
+registry = {}
+
+
+class TaskFailedError(Exception):
+    """Задача, результата которой ждали через ``call``, упала."""
+
+
+class Task:
+    """Функция, которую можно выполнить в фоновом воркере.
+
+    ``delay`` кладёт вызов в очередь Redis после коммита текущей
+    транзакции, чтобы воркер увидел записанные данные. При
+    ``TASKS_EAGER`` или недоступном Redis задача выполняется сразу
+    в том же процессе. ``call`` ещё и ждёт результата задачи.
+    """
+
+    def __init__(self, func, max_retries, retry_delay):
+        self.func = func
+        self.name = f'{func.__module__}.{func.__qualname__}'
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+    def delay(self, *args, **kwargs):
+        message = self._message(args, kwargs)
+        if settings.TASKS_EAGER:
+            transaction.on_commit(lambda: run_message(message))
+        else:
+            transaction.on_commit(lambda: enqueue_or_run(message))
+        return message['id']
+
+    def call(self, *args, timeout, pickup_timeout, **kwargs):
+        """Выполнить задачу в воркере и дождаться её результата.
+
+        Результат приходит в список Redis задачи, его ждёт BLPOP, а не
+        опрос кеша. Если за pickup_timeout секунд ни один воркер не взял
+        задачу (claim), её выполняет сам вызывающий: без воркеров запрос
+        не ждёт полный timeout. TimeoutError - взявший задачу воркер не
+        успел за timeout секунд, TaskFailedError - задача упала; повторов
+        нет.
+        """
+        if settings.TASKS_EAGER or not redis_available():
+            return self.func(*args, **kwargs)
+        message = self._message(args, kwargs)
+        message['reply_timeout'] = timeout
+        key = RESULT_KEY.format(message['id'])
+        deadline = time.monotonic() + timeout
+        try:
+            enqueue(message)
+            reply = _wait_reply(key, pickup_timeout)
+            if reply is None:
+                if claim(message):
+                    logger.warning(
+                        'No worker took task %s, running it inline',
+                        self.name,
+                    )
+                    return self.func(*args, **kwargs)
+                # Задачу уже взял воркер: ждём его результата.
+                reply = _wait_reply(key, deadline - time.monotonic())
+        except RedisError:
+            logger.warning('Task queue unavailable', exc_info=True)
+            return self.func(*args, **kwargs)
+        if reply is None:
+            raise TimeoutError(f'Task {self.name} {message["id"]} timed out')
+        ok, result = pickle.loads(reply)
+        if not ok:
+            raise TaskFailedError(result)
+        return result
+
+    def _message(self, args, kwargs):
+        return {
+            'id': uuid.uuid4().hex,
+            'task': self.name,
+            'args': args,
+            'kwargs': kwargs,
+            'attempt': 0,
+        }
+
+
+def task(func=None, *, max_retries=3, retry_delay=5):
+    """Зарегистрировать функцию как фоновую задачу."""
+    def decorator(func):
+        registered = Task(func, max_retries, retry_delay)
+        registry[registered.name] = registered
+        return registered
+    return decorator(func) if func is not None else decorator
+
+
+def get_task(name):
+    if name not in registry:
+        # Задачи вне приложений регистрируются при импорте своего модуля.
+        import_module(name.rpartition('.')[0])
+    return registry[name]
+
+
+@lru_cache(maxsize=None)
+def blocking_client():
+    """Клиент Redis без SOCKET_TIMEOUT кеша: BRPOP и BLPOP ждут дольше него."""
+    pool = get_redis_connection('default').connection_pool
+    return Redis(connection_pool=ConnectionPool(
+        connection_class=pool.connection_class,
+        **{**pool.connection_kwargs, 'socket_timeout': None},
+    ))
+
+
+def _wait_reply(key, timeout):
+    """Результат задачи из её списка или None через timeout секунд."""
+    # BLPOP с нулевым таймаутом ждал бы бесконечно.
+    if timeout <= 0:
+        return None
+    item = blocking_client().blpop(key, timeout=timeout)
+    return None if item is None else item[1]
+
+
+def enqueue(message, run_at=None):
+    client = get_redis_connection('default')
+    payload = json.dumps(message)
+    if run_at is None:
+        client.lpush(QUEUE_KEY, payload)
+    else:
+        client.zadd(DELAYED_KEY, {payload: run_at})
+
+
+def enqueue_or_run(message):
+    """Поставить задачу в очередь, а без Redis выполнить её на месте."""
+    if redis_available():
+        try:
+            enqueue(message)
+            return
+        except RedisError:
+            logger.warning('Task queue unavailable', exc_info=True)
+    logger.warning('Running task %s inline', message['task'])
+    run_message(message)
+
+
+def promote_delayed(client, now=None):
+    """Переложить в очередь отложенные задачи, чьё время пришло."""
+    now = time.time() if now is None else now
+    for payload in client.zrangebyscore(DELAYED_KEY, 0, now):
+        # ZREM защищает от двойного запуска при нескольких воркерах.
+        if client.zrem(DELAYED_KEY, payload):
+            client.lpush(QUEUE_KEY, payload)
+
+
+def claim(message):
+    """Взять задачу на выполнение; False - её уже взял другой.
+
+    Задачу, которую ждут через Task.call, выполняет тот, кто первым её
+    взял: воркер или сам ждущий, не дождавшийся воркера.
+    """
+    if 'reply_timeout' not in message:
+        return True
+    return cache.add(
+        CLAIM_KEY.format(message['id']), 1, message['reply_timeout']
+    )
+
+
+def run_message(message):
+    """Выполнить задачу; вернуть (успех, время в мс, текст ошибки).
+
+    Соединениями с БД не управляет: задачу могут выполнить и внутри
+    запроса (TASKS_EAGER, недоступный Redis). Их закрывает воркер.
+    """
+    start = time.perf_counter()
+    try:
+        result = get_task(message['task'])(
+            *message['args'], **message['kwargs']
+        )
+    except Exception as error:
+        logger.exception('Task %s failed', message['task'])
+        _reply(message, False, repr(error))
+        return False, (time.perf_counter() - start) * 1000, repr(error)
+    _reply(message, True, result)
+    return True, (time.perf_counter() - start) * 1000, None
+
+
+def _reply(message, ok, result):
+    """Отдать результат задачи, которую ждут через Task.call."""
+    if 'reply_timeout' not in message:
+        return
+    # Ждущий мог уже уйти: список истекает вместе с его таймаутом.
+    key = RESULT_KEY.format(message['id'])
+    try:
+        pipe = get_redis_connection('default').pipeline()
+        pipe.rpush(key, pickle.dumps((ok, result), pickle.HIGHEST_PROTOCOL))
+        pipe.expire(key, message['reply_timeout'])
+        pipe.execute()
+    except RedisError:
+        logger.warning('Failed to reply to task %s', message['id'],
+                       exc_info=True)
+
+
+def record_result(client, message, ok, elapsed_ms):
+    """Учесть время выполнения и, при ошибке, запланировать повтор."""
+    name = message['task']
+    pipe = client.pipeline(transaction=False)
+    pipe.hincrby(STATS_KEY, f'{name}:count', 1)
+    pipe.hincrbyfloat(STATS_KEY, f'{name}:ms', elapsed_ms)
+    if not ok:
+        pipe.hincrby(STATS_KEY, f'{name}:failed', 1)
+    pipe.execute()
+    logger.info(
+        'Task %s %s %s in %.1f ms',
+        name, message['id'], 'done' if ok else 'failed', elapsed_ms
+    )
+    if ok:
+        return
+    try:
+        registered = get_task(name)
+    except (ImportError, KeyError):
+        registered = None
+    if (registered is None or 'reply_timeout' in message
+            or message['attempt'] >= registered.max_retries):
+        logger.error('Task %s %s gave up', name, message['id'])
+        return
+    message = {**message, 'attempt': message['attempt'] + 1}
+    # Экспоненциальная задержка между попытками.
+    delay = registered.retry_delay * 2 ** (message['attempt'] - 1)
+    enqueue(message, run_at=time.time() + delay)
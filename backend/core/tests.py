@@ -0,0 +1,240 @@
+import threading
+import time
+from unittest import mock
+
+import pytest
+from django.core.cache import cache
+from django.db import connection, transaction
+from django_redis.cache import RedisCache
+from redis.exceptions import ConnectionError
+
+from .cache import STATS_KEY, bump_generation, get_or_compute
+from .cache_backend import CircuitBreaker, ResilientRedisCache
+from .tasks import claim, run_message, task
+
+
+class Counter:
+    """compute для get_or_compute, считающий свои вызовы."""
+
+    def __init__(self, delay=0):
+        self.calls = 0
+        self.delay = delay
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+            calls = self.calls
+        time.sleep(self.delay)
+        return f'value {calls}'
+
+
+def test_get_or_compute_caches_value():
+    compute = Counter()
+    assert get_or_compute('key', compute, 60, ('ns',)) == 'value 1'
+    assert get_or_compute('key', compute, 60, ('ns',)) == 'value 1'
+    assert compute.calls == 1
+
+
+def test_get_or_compute_single_flight():
+    compute = Counter(delay=0.3)
+    results = []
+
+    def worker():
+        results.append(get_or_compute('key', compute, 60, ('ns',)))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert compute.calls == 1
+    assert results == ['value 1'] * 8
+
+
+def test_get_or_compute_recomputes_after_generation_bump():
+    compute = Counter()
+    get_or_compute('key', compute, 60, ('ns',))
+    bump_generation('other')
+    assert get_or_compute('key', compute, 60, ('ns',)) == 'value 1'
+    bump_generation('ns')
+    assert get_or_compute('key', compute, 60, ('ns',)) == 'value 2'
+    assert compute.calls == 2
+
+
+def test_get_or_compute_serves_stale_while_locked():
+    compute = Counter()
+    get_or_compute('key', compute, 60, ('ns',))
+    bump_generation('ns')
+    # Пересчёт уже идёт в другом процессе.
+    cache.add('lock:key', 1, 30)
+    assert get_or_compute('key', compute, 60, ('ns',)) == 'value 1'
+    assert compute.calls == 1
+
+
+def test_get_or_compute_waits_without_stale_value(settings):
+    settings.CACHE_LOCK_WAIT = 0.2
+    compute = Counter()
+    cache.add('lock:key', 1, 30)
+    # Дождаться чужого результата не вышло: считаем сами.
+    assert get_or_compute('key', compute, 60, ('ns',)) == 'value 1'
+    assert compute.calls == 1
+
+
+def test_get_or_compute_keeps_lock_taken_over_by_another_process():
+    def compute():
+        # Расчёт дольше CACHE_LOCK_TIMEOUT: блокировка истекла, и её
+        # взял другой процесс.
+        cache.delete('lock:key')
+        cache.add('lock:key', 'other', 30)
+        return 'value'
+
+    assert get_or_compute('key', compute, 60, ('ns',)) == 'value'
+    assert cache.get('lock:key') == 'other'
+
+
+def test_get_or_compute_releases_own_lock():
+    get_or_compute('key', Counter(), 60, ('ns',))
+    assert cache.get('lock:key') is None
+
+
+def test_circuit_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10)
+    assert breaker.failure() is False
+    assert breaker.failure() is False
+    assert breaker.allow()
+    assert breaker.failure() is True
+    assert breaker.is_open
+    assert not breaker.allow()
+
+
+def test_circuit_breaker_half_open_probe():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    breaker.failure()
+    breaker.retry_at -= 11
+    assert breaker.allow()
+    # Пока проба не закончилась, остальные вызовы в Redis не идут.
+    assert not breaker.allow()
+    # Неудачная проверка снова размыкает цепь на полный период.
+    assert breaker.failure() is False
+    assert not breaker.allow()
+    breaker.retry_at -= 11
+    breaker.opened_at -= 11
+    assert breaker.allow()
+    downtime = breaker.success()
+    assert downtime >= 11
+    assert not breaker.is_open
+    assert breaker.allow()
+    assert breaker.success() is None
+
+
+def test_circuit_breaker_single_probe_across_threads():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+    breaker.failure()
+    breaker.retry_at -= 11
+    barrier = threading.Barrier(8)
+    allowed = []
+
+    def caller():
+        barrier.wait()
+        allowed.append(breaker.allow())
+
+    threads = [threading.Thread(target=caller) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert allowed.count(True) == 1
+
+
+@pytest.fixture
+def redis_down(monkeypatch):
+    """Все обращения RedisCache к серверу падают с ConnectionError."""
+    def fail(self, *args, **kwargs):
+        raise ConnectionError('Redis is down')
+
+    for method in ('get', 'set', 'delete', 'incr'):
+        monkeypatch.setattr(RedisCache, method, fail)
+    return monkeypatch
+
+
+def test_resilient_cache_falls_back_and_replays(redis_down):
+    backend = ResilientRedisCache('redis://127.0.0.1:1/1', {
+        'OPTIONS': {'FAILURE_THRESHOLD': 2, 'RESET_TIMEOUT': 10},
+    })
+    backend._client = mock.Mock()
+
+    backend.set('key', 'local')
+    assert not backend.is_degraded
+    assert backend.get('key') == 'local'
+    assert backend.is_degraded
+    backend.delete('stale')
+    assert backend.degraded_stats['outages'] == 1
+
+    deleted = []
+    redis_down.setattr(RedisCache, 'get', lambda self, key: 'redis')
+    redis_down.setattr(
+        RedisCache, 'delete', lambda self, key: deleted.append(key)
+    )
+    # Пока цепь разомкнута, Redis не спрашиваем.
+    assert backend.get('key') == 'local'
+    backend.breaker.retry_at -= 11
+    assert backend.get('key') == 'redis'
+    assert not backend.is_degraded
+    assert deleted == ['stale']
+    assert backend.fallback.get('key') is None
+    pipe = backend._client.get_client.return_value.pipeline.return_value
+    pipe.hincrby.assert_any_call(STATS_KEY, 'degraded:outages', 1)
+
+
+@task
+def double(value):
+    return value * 2
+
+
+@pytest.mark.django_db
+def test_run_message_keeps_request_connection():
+    message = {
+        'id': 'inline', 'task': double.name, 'args': [21], 'kwargs': {},
+        'attempt': 0,
+    }
+    # Задача выполняется внутри запроса с открытой транзакцией.
+    with transaction.atomic():
+        assert run_message(message)[0]
+        assert connection.connection is not None
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+
+
+def test_task_call_runs_inline_without_worker(task_queue):
+    start = time.monotonic()
+    assert double.call(21, timeout=30, pickup_timeout=0.1) == 42
+    assert time.monotonic() - start < 5
+    # Воркер, добравшийся до сообщения позже, его пропускает.
+    message, = task_queue
+    assert not claim(message)
+
+
+def test_task_call_waits_for_worker(task_queue, monkeypatch):
+    def worker(message):
+        assert claim(message)
+        # Работа дольше pickup_timeout: вызывающий должен ждать.
+        time.sleep(0.3)
+        run_message(message)
+
+    monkeypatch.setattr(
+        'core.tasks.enqueue',
+        lambda message: threading.Thread(
+            target=worker, args=(message,)
+        ).start(),
+    )
+    threads = []
+
+    def record(value):
+        threads.append(threading.current_thread())
+        return value * 2
+
+    monkeypatch.setattr(double, 'func', record)
+    assert double.call(21, timeout=5, pickup_timeout=0.1) == 42
+    assert len(threads) == 1
+    assert threads[0] is not threading.current_thread()
@@ -0,0 +1,120 @@
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from .cache import (GENERATION_KEY, after_cache_recovery, bump_generation,
+                    get_generation, redis_available)
+
+logger = logging.getLogger(__name__)
+
+FAVORITE = 'favorite'
+SHOPPING_CART = 'shopping_cart'
+FOLLOWING = 'following'
+
+SET_KEY = 'foodgram:viewer:{}:{}'
+# Метка загруженного множества: пустых множеств в Redis не бывает,
+# а id объектов начинаются с 1.
+LOADED = 0
+
+# Загрузка из БД пишет множество, только если поколение зрителя не
+# сменилось с начала чтения: иначе оно могло пропустить изменение.
+_LOAD_SCRIPT = """
+if redis.call('GET', KEYS[2]) ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+for i = 3, #ARGV, 5000 do
+    redis.call('SADD', KEYS[1], unpack(ARGV, i, math.min(i + 4999, #ARGV)))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+_CHANGE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call(ARGV[1], KEYS[1], unpack(ARGV, 2))
+end
+"""
+
+
+def _client():
+    return get_redis_connection('default')
+
+
+def _generation_key(user_id):
+    return cache.make_key(GENERATION_KEY.format(f'viewer:{user_id}'))
+
+
+def members(user_id, ids_by_kind, loaders):
+    """Какие из id входят в множества зрителя, по видам отношений.
+
+    ids_by_kind: {вид: id}; loaders: {вид: функция, отдающая все id
+    вида из БД}. Проверка всех видов - один конвейер SMISMEMBER;
+    множество, которого ещё нет в Redis, загружается из БД. При
+    недоступном Redis возвращает None.
+    """
+    if not redis_available():
+        return None
+    kinds = [kind for kind, ids in ids_by_kind.items() if ids]
+    ids_by_kind = {kind: list(ids_by_kind[kind]) for kind in kinds}
+    try:
+        pipe = _client().pipeline(transaction=False)
+        for kind in kinds:
+            pipe.smismember(
+                SET_KEY.format(user_id, kind), [LOADED, *ids_by_kind[kind]]
+            )
+        replies = pipe.execute()
+        found = {}
+        for kind, (loaded, *flags) in zip(kinds, replies):
+            if loaded:
+                found[kind] = {
+                    pk for pk, flag in zip(ids_by_kind[kind], flags) if flag
+                }
+            else:
+                all_ids = _load(user_id, kind, loaders[kind])
+                found[kind] = all_ids.intersection(ids_by_kind[kind])
+        return found
+    except RedisError:
+        logger.warning('Viewer sets unavailable', exc_info=True)
+        return None
+
+
+def _load(user_id, kind, loader):
+    generation = get_generation(f'viewer:{user_id}')
+    all_ids = set(loader())
+    _client().eval(
+        _LOAD_SCRIPT, 2,
+        SET_KEY.format(user_id, kind), _generation_key(user_id),
+        generation, settings.VIEWER_SET_TTL, LOADED, *all_ids,
+    )
+    return all_ids
+
+
+def viewer_set_changed(user_id, kind, ids, delta):
+    """Отразить изменение связей в множестве зрителя после коммита.
+
+    Поколение зрителя сдвигается тоже после коммита: так параллельная
+    загрузка, прочитавшая БД до коммита, не запишет устаревшее
+    множество, а кеш ответов - флаги по старым данным.
+    Если Redis недоступен, множество удаляется после его восстановления.
+    """
+    ids = list(ids)
+    key = SET_KEY.format(user_id, kind)
+
+    def apply():
+        bump_generation(f'viewer:{user_id}')
+        if redis_available():
+            try:
+                _client().eval(
+                    _CHANGE_SCRIPT, 1, key,
+                    'SADD' if delta > 0 else 'SREM', *ids,
+                )
+                return
+            except RedisError:
+                logger.warning('Viewer set update failed', exc_info=True)
+        after_cache_recovery(lambda client: client.delete(key))
+
+    transaction.on_commit(apply)
@@ -1,28 +1,93 @@
 import base64
-import imghdr
-import uuid
+import binascii
+import hashlib
+from io import BytesIO
 
 from django.core.files.base import ContentFile
+from PIL import Image
 from rest_framework import serializers
 
+from .images import variant_url
+
 MAX_IMAGE_SIZE = 5 * 1024 * 1024
+# Длина base64 для файла MAX_IMAGE_SIZE: 4 символа на каждые 3 байта.
+MAX_ENCODED_SIZE = 4 * ((MAX_IMAGE_SIZE + 2) // 3)
+MAX_IMAGE_PIXELS = 40_000_000
+# Размер куска для декодирования; кратен 4, чтобы не резать группы base64.
+DECODE_CHUNK_SIZE = 64 * 1024
+ALLOWED_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif', 'WEBP': 'webp'}
 
 
 class Base64ImageField(serializers.ImageField):
+    default_error_messages = {
+        'too_large': 'Размер изображения не должен превышать 5 МБ.',
+    }
+
     def to_internal_value(self, data):
         if isinstance(data, str) and data.startswith('data:image'):
-            format, imgstr = data.split(';base64,')
-            ext = format.split('/')[-1]
-            file_data = base64.b64decode(imgstr)
+            _, _, encoded = data.partition(';base64,')
+            # Слишком большой файл отсекаем по длине строки, не декодируя.
+            if len(encoded) > MAX_ENCODED_SIZE:
+                self.fail('too_large')
+            file_data = self._decode(encoded)
+            extension = self._validate_image(file_data)
+            content = file_data.getvalue()
+            # Имя по хешу содержимого: повторная загрузка той же картинки
+            # не создаёт новый файл (см. ContentAddressedStorage).
+            digest = hashlib.sha256(content).hexdigest()
+            return ContentFile(content, name=f'{digest}.{extension}')
 
-            if len(file_data) > MAX_IMAGE_SIZE:
-                raise serializers.ValidationError()
+        return super().to_internal_value(data)
 
-            file_name = f'{uuid.uuid4()}.{ext}'
-            valid_image = imghdr.what(None, file_data)
-            if not valid_image:
-                raise serializers.ValidationError()
+    def _decode(self, encoded):
+        file_data = BytesIO()
+        try:
+            for start in range(0, len(encoded), DECODE_CHUNK_SIZE):
+                file_data.write(base64.b64decode(
+                    encoded[start:start + DECODE_CHUNK_SIZE], validate=True
+                ))
+        except (binascii.Error, ValueError):
+            self.fail('invalid_image')
+        return file_data
 
-            return ContentFile(file_data, name=file_name)
+    def _validate_image(self, file_data):
+        """Проверить файл через Pillow и вернуть расширение по формату."""
+        try:
+            with Image.open(file_data) as image:
+                image_format = image.format
+                if image.width * image.height > MAX_IMAGE_PIXELS:
+                    self.fail('invalid_image')
+                image.verify()
+        except (OSError, SyntaxError, ValueError,
+                Image.DecompressionBombError):
+            self.fail('invalid_image')
+        if image_format not in ALLOWED_FORMATS:
+            self.fail('invalid_image')
+        return ALLOWED_FORMATS[image_format]
 
-        return super().to_internal_value(data)
+
+class ImageVariantField(serializers.ImageField):
+    """Ссылка на уменьшенную копию изображения нужного размера.
+
+    ``list_variant`` используется, когда объект выводится в списке.
+    """
+
+    def __init__(self, variant, list_variant=None, **kwargs):
+        self.variant = variant
+        self.list_variant = list_variant or variant
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        if not value:
+            return None
+        in_list = isinstance(
+            getattr(self.parent, 'parent', None), serializers.ListSerializer
+        )
+        url = variant_url(
+            value, self.list_variant if in_list else self.variant
+        )
+        request = self.context.get('request')
+        if request is not None:
+            return request.build_absolute_uri(url)
+        return url
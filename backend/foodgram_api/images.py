@@ -0,0 +1,92 @@
+import os
+from io import BytesIO
+
+from core.cache import bump_generation
+from core.local_cache import LocalLRUCache
+from core.tasks import task
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+RECIPE_IMAGE_VARIANTS = ('card', 'detail')
+AVATAR_VARIANTS = ('avatar',)
+# Отметка, что копия уже лежит в хранилище; ставит generate_image_variants.
+VARIANT_READY_KEY = 'image_variant:{}'
+
+_local_ready = LocalLRUCache(
+    settings.IMAGE_VARIANT_LOCAL_SIZE, settings.IMAGE_VARIANT_LOCAL_TTL
+)
+
+
+def variant_name(name, variant):
+    root, _ = os.path.splitext(name)
+    return f'{root}_{variant}.webp'
+
+
+def variant_ready(name):
+    """Готова ли копия: по отметке в кеше, без обращения к хранилищу.
+
+    Готовность запоминается и в памяти процесса, отсутствие - нет:
+    копия появится, как только отработает задача.
+    """
+    if _local_ready.get(name):
+        return True
+    if cache.get(VARIANT_READY_KEY.format(name)):
+        _local_ready.set(name, True)
+        return True
+    return False
+
+
+def forget_variants(names):
+    cache.delete_many([VARIANT_READY_KEY.format(name) for name in names])
+
+
+def variant_url(field_file, variant):
+    """URL уменьшенной копии; пока её нет - URL оригинала."""
+    name = variant_name(field_file.name, variant)
+    if variant_ready(name):
+        return default_storage.url(name)
+    return field_file.url
+
+
+@task
+def generate_image_variants(name, variants, namespaces=()):
+    """Собрать уменьшенные WebP-копии изображения из хранилища."""
+    if not default_storage.exists(name):
+        return
+    with default_storage.open(name) as source:
+        with Image.open(source) as original:
+            image = ImageOps.exif_transpose(original)
+            image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info
+                              else 'RGB')
+
+    ready = {}
+    for variant in variants:
+        target = variant_name(name, variant)
+        ready[VARIANT_READY_KEY.format(target)] = True
+        if default_storage.exists(target):
+            continue
+        resized = image.copy()
+        resized.thumbnail(
+            settings.IMAGE_VARIANTS[variant], Image.Resampling.LANCZOS
+        )
+        buffer = BytesIO()
+        resized.save(
+            buffer, 'WEBP', quality=settings.IMAGE_VARIANT_QUALITY
+        )
+        default_storage.save(target, ContentFile(buffer.getvalue()))
+    cache.set_many(ready, None)
+    # Кешированные ответы со ссылкой на оригинал пора пересобрать.
+    for namespace in namespaces:
+        bump_generation(namespace)
+
+
+def schedule_image_variants(field_file, variants, namespaces=()):
+    if field_file:
+        generate_image_variants.delay(
+            field_file.name, list(variants), list(namespaces)
+        )
@@ -0,0 +1,90 @@
+import time
+
+from core.tasks import task
+from django.apps import apps
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from .images import forget_variants, variant_name
+
+# Поля моделей, которые ссылаются на файлы в MEDIA_ROOT.
+MEDIA_FIELDS = (
+    ('recipes.Recipe', 'image'),
+    ('users.User', 'avatar'),
+)
+
+
+def reference_count(name):
+    """Сколько строк во всех MEDIA_FIELDS ссылаются на файл."""
+    return sum(
+        apps.get_model(model).objects.filter(**{field: name}).count()
+        for model, field in MEDIA_FIELDS
+    )
+
+
+def referenced_files():
+    """Все файлы, на которые есть ссылки, вместе с их копиями."""
+    names = set()
+    for model, field in MEDIA_FIELDS:
+        for name in apps.get_model(model).objects.exclude(
+            **{field: ''}
+        ).exclude(
+            **{f'{field}__isnull': True}
+        ).values_list(field, flat=True).iterator():
+            names.add(name)
+            names.update(
+                variant_name(name, variant)
+                for variant in settings.IMAGE_VARIANTS
+            )
+    return names
+
+
+@task
+def release_media_file(name):
+    """Удалить файл и его копии, если на него больше никто не ссылается.
+
+    Недавно изменённый файл остаётся сборщику gc_media: та же картинка
+    могла только что загрузиться заново, и ссылка на неё ещё не в БД.
+    """
+    if reference_count(name) or recently_modified(name):
+        return
+    variants = [
+        variant_name(name, variant) for variant in settings.IMAGE_VARIANTS
+    ]
+    forget_variants(variants)
+    for path in [name] + variants:
+        if default_storage.exists(path):
+            default_storage.delete(path)
+
+
+def recently_modified(name):
+    """Изменялся ли файл в пределах MEDIA_GRACE_PERIOD."""
+    try:
+        modified = default_storage.get_modified_time(name).timestamp()
+    except FileNotFoundError:
+        return False
+    return modified > time.time() - settings.MEDIA_GRACE_PERIOD
+
+
+def remember_file(instance, field, update_fields=None):
+    """Запомнить файл до сохранения, чтобы потом отпустить заменённый."""
+    old_name = None
+    if instance.pk is not None and (
+        update_fields is None or field in update_fields
+    ):
+        old_name = type(instance).objects.filter(
+            pk=instance.pk
+        ).values_list(field, flat=True).first()
+    instance.__dict__.setdefault('_old_files', {})[field] = old_name
+
+
+def release_replaced_file(instance, field):
+    old_name = instance.__dict__.get('_old_files', {}).pop(field, None)
+    if old_name and old_name != getattr(instance, field).name:
+        release_media_file.delay(old_name)
+
+
+def release_deleted_file(instance, field):
+    name = getattr(instance, field).name
+    if name:
+        release_media_file.delay(name)
@@ -29,6 +29,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "django_filters",
     "rest_framework",
     "rest_framework.authtoken",
@@ -83,22 +84,87 @@ DATABASES = {
         'USER': os.getenv('POSTGRES_USER', 'django'),
         'PASSWORD': os.getenv('POSTGRES_PASSWORD', 'mysecretpassword'),
         'HOST': os.getenv('DB_HOST', 'db'),
-        'PORT': os.getenv('DB_PORT', 5432)
+        'PORT': os.getenv('DB_PORT', 5432),
+        'OPTIONS': {
+            # Пороги нечёткого поиска по триграммам (операторы % и %>).
+            'options': (
+                '-c pg_trgm.similarity_threshold=0.3 '
+                '-c pg_trgm.word_similarity_threshold=0.5'
+            ),
+        },
     }
 }
 
 CACHES = {
     "default": {
-        "BACKEND": "django_redis.cache.RedisCache",
+        # При недоступном Redis работает на локальном кеше процесса.
+        "BACKEND": "core.cache_backend.ResilientRedisCache",
         "LOCATION": "redis://redis:6379/1",
         "OPTIONS": {
             "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            # Короткие таймауты: упавший Redis не должен держать запрос.
+            "SOCKET_CONNECT_TIMEOUT": 0.25,
+            "SOCKET_TIMEOUT": 0.25,
+            # Ошибок подряд до перехода на локальный кеш и пауза, секунд,
+            # до следующей попытки обратиться к Redis.
+            "FAILURE_THRESHOLD": 3,
+            "RESET_TIMEOUT": 5,
+            "FALLBACK_MAX_ENTRIES": 5000,
         },
         "KEY_PREFIX": "foodgram"
     }
 }
 
 CACHE_TTL = 60 * 15  # 15 минут
+# Локальный уровень кеша в каждом воркере (core.cache.TieredCache).
+LOCAL_CACHE_MAX_ITEMS = 2000
+LOCAL_CACHE_MAX_BYTES = 64 * 1024 * 1024
+LOCAL_CACHE_TTL = 60 * 5
+# Как часто воркер сбрасывает счётчики попаданий в Redis, секунд.
+CACHE_STATS_INTERVAL = 10
+# core.cache.get_or_compute: сколько отдавать устаревшее значение, пока
+# его пересчитывает другой запрос; блокировка пересчёта и сколько её
+# ждать без устаревшего значения; коэффициент раннего пересчёта XFetch.
+CACHE_STALE_TTL = 60
+CACHE_LOCK_TIMEOUT = 30
+CACHE_LOCK_WAIT = 5
+CACHE_XFETCH_BETA = 1.0
+# Счётчики избранного, корзин, рецептов и подписчиков в общих шаблонах
+# ответов подставляются из своего кеша (core.counters); он сбрасывается
+# при изменении счётчика, TTL ограничивает гонку с чтением до коммита.
+COUNTERS_TTL = 60
+# Профиль без флагов зрителя сбрасывается поколением user:<pk>.
+USER_PROFILE_TTL = 60 * 60 * 24
+SHOPPING_LIST_TTL = 60 * 60 * 24  # запись устаревает вместе с корзиной
+# PDF собирает воркер задач; если за PICKUP_TIMEOUT секунд ни один
+# воркер не взял задачу, запрос собирает файл сам.
+SHOPPING_LIST_PDF_TIMEOUT = 30
+SHOPPING_LIST_PDF_PICKUP_TIMEOUT = 1
+SHOPPING_LIST_PDF_FONT = os.getenv(
+    'SHOPPING_LIST_PDF_FONT',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+)
+# Форматы, которые фоновый воркер собирает заранее при изменении корзины.
+SHOPPING_LIST_PRERENDER_FORMATS = ('pdf',)
+# Сколько рецептов можно создать одним запросом /api/recipes/import/.
+RECIPE_IMPORT_MAX_SIZE = 50
+# Сколько id принимают массовые избранное, корзина и подписки.
+BULK_RELATION_MAX_SIZE = 500
+
+# Пользователь по токену (api.authentication): в Redis и в памяти
+# процесса. Сброс в памяти виден только своему процессу, поэтому TTL
+# там короткий.
+AUTH_TOKEN_CACHE_TTL = 60 * 60
+AUTH_TOKEN_LOCAL_TTL = 5
+AUTH_TOKEN_LOCAL_SIZE = 10000
+
+# Множества избранного, корзины и подписок зрителя в Redis
+# (core.viewer_sets); обновляются при записи, TTL - страховка.
+VIEWER_SET_TTL = 60 * 60 * 24
+
+# Фоновые задачи (core.tasks). В режиме EAGER выполняются сразу,
+# без очереди и воркера.
+TASKS_EAGER = os.getenv('TASKS_EAGER', 'False') == 'True'
 SESSION_ENGINE = "django.contrib.sessions.backends.cache"
 SESSION_CACHE_ALIAS = "default"
 """
@@ -141,7 +207,7 @@ REST_FRAMEWORK = {
         "rest_framework.permissions.AllowAny",
     ],
     "DEFAULT_AUTHENTICATION_CLASSES": [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ],
     "DEFAULT_FILTER_BACKENDS": [
         "django_filters.rest_framework.DjangoFilterBackend",
@@ -190,6 +256,29 @@ AUTHENTICATION_BACKENDS = (
 
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "mediafiles"
+# Файлы, изменённые позже, не удаляются: ссылку на только что
+# загруженный файл БД получит после коммита.
+MEDIA_GRACE_PERIOD = 60 * 60
+
+STORAGES = {
+    "default": {
+        "BACKEND": "foodgram_api.storage.ContentAddressedStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage",
+    },
+}
+
+# Уменьшенные WebP-копии изображений: максимальные ширина и высота.
+IMAGE_VARIANTS = {
+    "card": (480, 480),
+    "detail": (1200, 1200),
+    "avatar": (192, 192),
+}
+IMAGE_VARIANT_QUALITY = 80
+# Готовые копии, запомненные в памяти процесса (foodgram_api.images).
+IMAGE_VARIANT_LOCAL_TTL = 60
+IMAGE_VARIANT_LOCAL_SIZE = 10000
 
 STATIC_URL = "/static/"
 STATIC_ROOT = BASE_DIR / "staticfiles"
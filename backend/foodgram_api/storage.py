@@ -0,0 +1,24 @@
+import os
+import re
+
+from django.core.files.storage import FileSystemStorage
+
+CONTENT_HASH_NAME = re.compile(r'^[0-9a-f]{64}\.\w+$')
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """Хранилище, не пишущее повторно файлы с одинаковым содержимым.
+
+    Имя вида ``<sha256>.<ext>`` однозначно задаёт содержимое, поэтому
+    если такой файл уже есть, запись пропускается. Остальные имена
+    сохраняются как обычно.
+    """
+
+    def save(self, name, content, max_length=None):
+        if (name and CONTENT_HASH_NAME.match(os.path.basename(name))
+                and self.exists(name)):
+            # Свежее время изменения защищает файл от сборщика мусора,
+            # пока ссылка на него ещё не записана в БД.
+            os.utime(self.path(name))
+            return name
+        return super().save(name, content, max_length)
@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'foodgram_api.settings')
 
 application = get_wsgi_application()
+
+# Индекс автодополнения ингредиентов строится при старте воркера,
+# а не на первом запросе пользователя.
+from recipes.ingredient_index import ingredient_index  # noqa: E402
+
+ingredient_index.warm()
@@ -1,7 +1,8 @@
 from django.contrib import admin
 
 from .models import (Favorite, Ingredient, Recipe, RecipeIngredient,
-                     ShoppingCart)
+                     ShoppingCart, ShoppingCartIngredient,
+                     track_ingredient_edits)
 
 
 class RecipeIngredientInline(admin.TabularInline):
@@ -11,14 +12,18 @@ class RecipeIngredientInline(admin.TabularInline):
 
 @admin.register(Recipe)
 class RecipeAdmin(admin.ModelAdmin):
-    list_display = ('name', 'author', 'get_favorites_count')
+    list_display = ('name', 'author', 'favorites_count', 'in_carts_count')
     search_fields = ('author__username', 'name')
     list_filter = ('author', 'name', 'pub_date')
+    list_select_related = ('author',)
+    readonly_fields = ('favorites_count', 'in_carts_count')
     inlines = (RecipeIngredientInline,)
 
-    @admin.display(description='Количество добавлений в избранное')
-    def get_favorites_count(self, obj):
-        return obj.favorited_by.count()
+    def save_related(self, request, form, formsets, change):
+        # Инлайн пишет ингредиенты мимо сериализатора API и после
+        # save_model: вектор и корзины обновляются здесь.
+        with track_ingredient_edits([form.instance.pk]):
+            super().save_related(request, form, formsets, change)
 
 
 @admin.register(Ingredient)
@@ -34,6 +39,22 @@ class RecipeIngredientAdmin(admin.ModelAdmin):
     search_fields = ('recipe__name', 'ingredient__name')
     list_filter = ('recipe', 'ingredient')
 
+    def save_model(self, request, obj, form, change):
+        # Строку могли перенести в другой рецепт: учитываем оба.
+        recipe_ids = {obj.recipe_id, form.initial.get('recipe', obj.recipe_id)}
+        with track_ingredient_edits(recipe_ids):
+            super().save_model(request, obj, form, change)
+
+    def delete_model(self, request, obj):
+        with track_ingredient_edits([obj.recipe_id]):
+            super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        with track_ingredient_edits(set(
+            queryset.values_list('recipe_id', flat=True)
+        )):
+            super().delete_queryset(request, queryset)
+
 
 @admin.register(Favorite)
 class FavoriteAdmin(admin.ModelAdmin):
@@ -47,3 +68,10 @@ class ShoppingCartAdmin(admin.ModelAdmin):
     list_display = ('user', 'recipe')
     search_fields = ('user__email', 'recipe__name')
     list_filter = ('user', 'recipe')
+
+
+@admin.register(ShoppingCartIngredient)
+class ShoppingCartIngredientAdmin(admin.ModelAdmin):
+    list_display = ('user', 'ingredient', 'amount')
+    search_fields = ('user__email', 'ingredient__name')
+    readonly_fields = ('user', 'ingredient', 'amount')
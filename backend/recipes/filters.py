@@ -1,8 +1,32 @@
+from api.viewer_state import ViewerState
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            TrigramWordSimilarity)
+from django.db.models import F, Q
 from django_filters import rest_framework
 from recipes.models import Ingredient, Recipe
 
 
+class TrigramSearchMixin:
+    """Нечёткий поиск по названию с ранжированием по сходству.
+
+    Оператор ``%>`` отбирает строки по GIN-индексу с ``gin_trgm_ops``
+    и порогу ``pg_trgm.word_similarity_threshold``, поэтому поиск
+    устойчив к опечаткам и не сканирует таблицу целиком.
+    """
+
+    def filter_search(self, queryset, name, value):
+        value = value.strip()
+        if not value:
+            return queryset
+        return queryset.filter(
+            name__trigram_word_similar=value
+        ).annotate(
+            similarity=TrigramWordSimilarity(value, 'name')
+        ).order_by('-similarity', *queryset.model._meta.ordering)
+
+
 class RecipeFilter(rest_framework.FilterSet):
+    search = rest_framework.filters.CharFilter(method='filter_search')
     is_favorited = rest_framework.filters.BooleanFilter(
         method='filter_is_favorited'
     )
@@ -12,27 +36,46 @@ class RecipeFilter(rest_framework.FilterSet):
 
     class Meta:
         model = Recipe
-        fields = ['author', 'is_favorited', 'is_in_shopping_cart']
+        fields = ['author', 'is_favorited', 'is_in_shopping_cart', 'search']
+
+    def filter_search(self, queryset, name, value):
+        """Полнотекстовый поиск по названию, описанию и ингредиентам.
+
+        Слова приводятся к основе русским стеммером, совпадения ищутся
+        по хранимому ``search_vector`` (GIN) и ранжируются ``ts_rank``.
+        Опечатки в названии добирает триграммный поиск.
+        """
+        value = value.strip()
+        if not value:
+            return queryset
+        query = SearchQuery(value, config='russian', search_type='websearch')
+        return queryset.filter(
+            Q(search_vector=query) | Q(name__trigram_word_similar=value)
+        ).annotate(
+            rank=SearchRank(F('search_vector'), query),
+            similarity=TrigramWordSimilarity(value, 'name'),
+        ).order_by('-rank', '-similarity', '-pub_date')
 
     def filter_is_favorited(self, queryset, name, value):
-        user = self.request.user
-        if user.is_authenticated and value:
-            return queryset.filter(favorited_by__user=user)
+        if value:
+            return ViewerState(self.request.user).filter_favorited(queryset)
         return queryset
 
     def filter_is_in_shopping_cart(self, queryset, name, value):
-        user = self.request.user
-        if user.is_authenticated and value:
-            return queryset.filter(in_shopping_carts__user=user)
+        if value:
+            return ViewerState(
+                self.request.user
+            ).filter_in_shopping_cart(queryset)
         return queryset
 
 
-class IngredientFilter(rest_framework.FilterSet):
+class IngredientFilter(TrigramSearchMixin, rest_framework.FilterSet):
     name = rest_framework.filters.CharFilter(
         field_name='name',
         lookup_expr='istartswith',
     )
+    search = rest_framework.filters.CharFilter(method='filter_search')
 
     class Meta:
         model = Ingredient
-        fields = ['name']
+        fields = ['name', 'search']
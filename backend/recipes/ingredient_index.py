@@ -0,0 +1,104 @@
+import bisect
+import logging
+import threading
+import time
+
+from core.cache import get_generation
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.renderers import JSONRenderer
+
+from .models import Ingredient
+from .serializers import IngredientSerializer
+
+logger = logging.getLogger(__name__)
+
+# Как часто сверяться с поколением кеша, чтобы подхватить изменения,
+# сделанные в других воркерах.
+CHECK_INTERVAL = 5
+
+
+class IngredientIndex:
+    """Индекс ингредиентов в памяти воркера для автодополнения.
+
+    Названия хранятся отсортированными в нижнем регистре (casefold)
+    вместе с готовым JSON каждой записи. Префикс ищется бинарным
+    поиском, ответ собирается склейкой байтов без обращения к БД.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = ([], [])
+        self._generation = None
+        self._checked_at = 0.0
+
+    def warm(self):
+        """Построить индекс при старте воркера, если БД и кеш доступны."""
+        try:
+            self._rebuild()
+        except Exception:
+            logger.warning('Ingredient index warm-up failed', exc_info=True)
+
+    def invalidate(self):
+        self._generation = None
+
+    def search(self, query):
+        """Найти ингредиенты: точные совпадения, префиксы, подстроки.
+
+        Точные совпадения стоят в начале диапазона префикса, так как
+        строка меньше любого своего продолжения.
+        """
+        self._ensure_fresh()
+        names, entries = self._data
+        query = query.strip().casefold()
+        if not query:
+            return self._render(entries)
+
+        start = bisect.bisect_left(names, query)
+        end = bisect.bisect_left(names, query + '\U0010ffff', lo=start)
+        substring = [
+            entries[i] for i, name in enumerate(names)
+            if query in name and not start <= i < end
+        ]
+        return self._render(entries[start:end] + substring)
+
+    def _render(self, entries):
+        return b'[' + b','.join(entries) + b']'
+
+    def _ensure_fresh(self):
+        now = time.monotonic()
+        if (self._generation is not None
+                and now - self._checked_at < CHECK_INTERVAL):
+            return
+        generation = get_generation('ingredients')
+        self._checked_at = now
+        if generation != self._generation:
+            self._rebuild(generation)
+
+    def _rebuild(self, generation=None):
+        with self._lock:
+            if generation is None:
+                generation = get_generation('ingredients')
+            if generation == self._generation:
+                return
+            renderer = JSONRenderer()
+            rows = sorted(
+                (item['name'].casefold(), item['id'], renderer.render(item))
+                for item in IngredientSerializer(
+                    Ingredient.objects.all(), many=True
+                ).data
+            )
+            self._data = (
+                [name for name, _, _ in rows],
+                [entry for _, _, entry in rows],
+            )
+            self._generation = generation
+            self._checked_at = time.monotonic()
+
+
+ingredient_index = IngredientIndex()
+
+
+@receiver([post_save, post_delete], sender=Ingredient)
+def invalidate_ingredient_index(sender, instance, **kwargs):
+    ingredient_index.invalidate()
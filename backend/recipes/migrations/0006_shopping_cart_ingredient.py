@@ -0,0 +1,42 @@
+# Generated by Django 5.2.1 on 2026-10-18 19:54
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0005_recipe_search_vector'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShoppingCartIngredient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.IntegerField(verbose_name='Количество')),
+                ('ingredient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shopping_cart_totals', to='recipes.ingredient', verbose_name='Ингредиент')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shopping_cart_ingredients', to=settings.AUTH_USER_MODEL, verbose_name='Пользователь')),
+            ],
+            options={
+                'verbose_name': 'Ингредиент в корзине',
+                'verbose_name_plural': 'Ингредиенты в корзинах',
+                'constraints': [models.UniqueConstraint(fields=('user', 'ingredient'), name='unique_shopping_cart_ingredient')],
+            },
+        ),
+        migrations.RunSQL(
+            """
+            INSERT INTO recipes_shoppingcartingredient
+                (user_id, ingredient_id, amount)
+            SELECT cart.user_id, ri.ingredient_id, SUM(ri.amount)
+            FROM recipes_shoppingcart AS cart
+            JOIN recipes_recipeingredient AS ri
+                ON ri.recipe_id = cart.recipe_id
+            GROUP BY cart.user_id, ri.ingredient_id
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
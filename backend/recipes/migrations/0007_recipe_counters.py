@@ -0,0 +1,47 @@
+# Generated by Django 5.2.1 on 2026-10-18 19:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0006_shopping_cart_ingredient'),
+        ('users', '0002_user_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='favorites_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Добавлений в избранное'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='in_carts_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Добавлений в корзину'),
+        ),
+        migrations.RunSQL(
+            """
+            UPDATE recipes_recipe AS recipe SET
+                favorites_count = (
+                    SELECT COUNT(*) FROM recipes_favorite
+                    WHERE recipe_id = recipe.id
+                ),
+                in_carts_count = (
+                    SELECT COUNT(*) FROM recipes_shoppingcart
+                    WHERE recipe_id = recipe.id
+                );
+            UPDATE users_user AS author SET
+                recipes_count = (
+                    SELECT COUNT(*) FROM recipes_recipe
+                    WHERE author_id = author.id
+                ),
+                followers_count = (
+                    SELECT COUNT(*) FROM users_follow
+                    WHERE following_id = author.id
+                );
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
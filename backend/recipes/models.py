@@ -1,9 +1,23 @@
+from contextlib import contextmanager
+
+from core.cache import bump_generations_on_commit
+from core.counters import change_counter, forget_counters, loaded_fields
+from core.relations import UserRelationManager
+from core.viewer_sets import FAVORITE, SHOPPING_CART, viewer_set_changed
 from django.contrib.auth import get_user_model
-from django.core.cache import cache
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.core.validators import MinValueValidator
-from django.db import models
-from django.db.models.signals import post_delete, post_save
+from django.db import connection, models, transaction
+from django.db.models import OuterRef, Subquery, TextField, Value
+from django.db.models.functions import Coalesce
+from django.db.models.signals import (post_delete, post_save, pre_delete,
+                                      pre_save)
 from django.dispatch import receiver
+from django.utils import timezone
+from foodgram_api.media import (release_deleted_file, release_replaced_file,
+                                remember_file)
 
 User = get_user_model()
 
@@ -23,6 +37,13 @@ class Ingredient(models.Model):
 
     class Meta:
         ordering = ['name']
+        indexes = [
+            GinIndex(
+                fields=['name'],
+                name='ingredient_name_trgm_idx',
+                opclasses=['gin_trgm_ops']
+            ),
+        ]
         verbose_name = "Ингредиент"
         verbose_name_plural = "Ингредиенты"
 
@@ -39,6 +60,10 @@ class Recipe(models.Model):
         auto_now_add=True,
         verbose_name="Дата публикации"
     )
+    updated_at = models.DateTimeField(
+        auto_now=True,
+        verbose_name="Дата изменения"
+    )
     author = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
@@ -61,17 +86,92 @@ class Recipe(models.Model):
         blank=True,
         verbose_name="Изображение рецепта"
     )
+    search_vector = SearchVectorField(
+        null=True,
+        editable=False,
+        verbose_name="Поисковый вектор"
+    )
+    favorites_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name="Добавлений в избранное"
+    )
+    in_carts_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name="Добавлений в корзину"
+    )
+
+    # Поля рецепта в поисковом векторе (кроме ингредиентов).
+    SEARCH_FIELDS = ('name', 'text')
+    COUNTER_FIELDS = ('favorites_count', 'in_carts_count')
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # Вектор пишет только update_search_vectors, счётчики -
+            # change_counter: значения в объекте могли устареть.
+            kwargs['update_fields'] = loaded_fields(
+                self, ('search_vector', *self.COUNTER_FIELDS)
+            )
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        recipe = super().from_db(db, field_names, values)
+        recipe.remember_search_text()
+        return recipe
+
+    def remember_search_text(self):
+        """Запомнить загруженные поля вектора для search_text_changed."""
+        self._search_text = {
+            field: self.__dict__[field]
+            for field in self.SEARCH_FIELDS if field in self.__dict__
+        }
+
+    def search_text_changed(self, update_fields=None):
+        """Изменились ли название или описание с загрузки из БД."""
+        if update_fields is not None and not (
+            set(self.SEARCH_FIELDS) & set(update_fields)
+        ):
+            return False
+        saved = getattr(self, '_search_text', {})
+        return any(
+            field not in saved or saved[field] != self.__dict__[field]
+            for field in self.SEARCH_FIELDS if field in self.__dict__
+        )
+
     class Meta:
         ordering = ['-pub_date']
+        indexes = [
+            models.Index(
+                fields=['-pub_date', '-id'],
+                name='recipe_pub_date_id_idx'
+            ),
+            GinIndex(
+                fields=['name'],
+                name='recipe_name_trgm_idx',
+                opclasses=['gin_trgm_ops']
+            ),
+            GinIndex(
+                fields=['search_vector'],
+                name='recipe_search_vector_idx'
+            ),
+        ]
         verbose_name = "Рецепт"
         verbose_name_plural = "Рецепты"
 
 
 class RecipeIngredient(models.Model):
+    """Ингредиент рецепта.
+
+    Сигналов на строках нет: агрегат корзин получает разницу от
+    RecipeCreateUpdateSerializer, а другие правки (админка, shell)
+    оборачиваются в track_ingredient_edits.
+    """
+
     recipe = models.ForeignKey(
         Recipe,
         on_delete=models.CASCADE,
@@ -110,6 +210,13 @@ class RecipeIngredient(models.Model):
         )
 
 
+class FavoriteManager(UserRelationManager):
+    target_field = 'recipe'
+
+    def changed(self, user_id, target_ids, delta):
+        favorites_changed(user_id, target_ids, delta)
+
+
 class Favorite(models.Model):
     user = models.ForeignKey(
         User,
@@ -124,6 +231,8 @@ class Favorite(models.Model):
         verbose_name="Рецепт"
     )
 
+    objects = FavoriteManager()
+
     class Meta:
         constraints = [
             models.UniqueConstraint(
@@ -138,6 +247,21 @@ class Favorite(models.Model):
         return f"{self.user.username} → {self.recipe.name}"
 
 
+class ShoppingCartManager(UserRelationManager):
+    target_field = 'recipe'
+
+    def changed(self, user_id, target_ids, delta):
+        # Рецепты на месте и при удалении из корзины: их ингредиенты
+        # ещё можно вычесть из агрегата.
+        if delta > 0:
+            ShoppingCartIngredient.objects.add_recipes(target_ids, [user_id])
+        else:
+            ShoppingCartIngredient.objects.remove_recipes(
+                target_ids, [user_id]
+            )
+        carts_changed(user_id, target_ids, delta)
+
+
 class ShoppingCart(models.Model):
     user = models.ForeignKey(
         User,
@@ -152,6 +276,8 @@ class ShoppingCart(models.Model):
         verbose_name="Рецепт"
     )
 
+    objects = ShoppingCartManager()
+
     class Meta:
         constraints = [
             models.UniqueConstraint(
@@ -166,13 +292,371 @@ class ShoppingCart(models.Model):
         return f"{self.user.username} - {self.recipe.name}"
 
 
+class ShoppingCartIngredientManager(models.Manager):
+    """Поддержка агрегата корзины одним SQL-запросом на изменение."""
+
+    def add_recipe(self, recipe_id, user_ids):
+        self.add_recipes([recipe_id], user_ids)
+
+    def remove_recipe(self, recipe_id, user_ids):
+        self.remove_recipes([recipe_id], user_ids)
+
+    def add_recipes(self, recipe_ids, user_ids):
+        self._apply_recipes(recipe_ids, user_ids, self._ADD_SQL)
+
+    def remove_recipes(self, recipe_ids, user_ids):
+        self._apply_recipes(recipe_ids, user_ids, self._REMOVE_SQL)
+
+    def apply_deltas(self, user_ids, deltas):
+        """Изменить суммы ингредиентов в корзинах пользователей.
+
+        deltas: {ingredient_id: изменение количества}.
+        """
+        user_ids = list(user_ids)
+        if not user_ids or not deltas:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(self._DELTAS_SQL, {
+                'users': user_ids,
+                'ingredients': list(deltas),
+                'deltas': list(deltas.values()),
+            })
+
+    def rebuild(self, user_ids=None):
+        """Пересчитать агрегат заново из корзин (для сверки и починки)."""
+        queryset = self.all()
+        if user_ids is not None:
+            queryset = queryset.filter(user_id__in=user_ids)
+        queryset.delete()
+        self.bulk_create(
+            ShoppingCartIngredient(
+                user_id=item['user_id'],
+                ingredient_id=item['ingredient_id'],
+                amount=item['total'],
+            )
+            for item in self._expected(user_ids)
+        )
+
+    def mismatches(self, user_ids=None):
+        """Расхождения агрегата с SUM по корзинам: (user, ingredient)."""
+        expected = {
+            (item['user_id'], item['ingredient_id']): item['total']
+            for item in self._expected(user_ids)
+        }
+        queryset = self.all()
+        if user_ids is not None:
+            queryset = queryset.filter(user_id__in=user_ids)
+        actual = {
+            (user_id, ingredient_id): amount
+            for user_id, ingredient_id, amount in queryset.values_list(
+                'user_id', 'ingredient_id', 'amount'
+            )
+        }
+        return {
+            key: (expected.get(key), actual.get(key))
+            for key in expected.keys() | actual.keys()
+            if expected.get(key) != actual.get(key)
+        }
+
+    def _expected(self, user_ids):
+        queryset = ShoppingCart.objects.all()
+        if user_ids is not None:
+            queryset = queryset.filter(user_id__in=user_ids)
+        return queryset.values(
+            'user_id',
+            ingredient_id=models.F('recipe__recipe_ingredients__ingredient'),
+        ).filter(ingredient_id__isnull=False).annotate(
+            total=models.Sum('recipe__recipe_ingredients__amount')
+        ).order_by()
+
+    # Блокировка рецепта FOR SHARE не даёт агрегату разойтись с
+    # одновременной правкой ингредиентов (она берёт FOR UPDATE).
+    _ADD_SQL = """
+        SELECT 1 FROM recipes_recipe WHERE id = ANY(%(recipes)s::bigint[])
+        FOR SHARE;
+        INSERT INTO recipes_shoppingcartingredient
+            (user_id, ingredient_id, amount)
+        SELECT u.id, ri.ingredient_id, SUM(ri.amount)
+        FROM unnest(%(users)s::bigint[]) AS u(id)
+        CROSS JOIN recipes_recipeingredient AS ri
+        WHERE ri.recipe_id = ANY(%(recipes)s::bigint[])
+        GROUP BY u.id, ri.ingredient_id
+        ON CONFLICT (user_id, ingredient_id) DO UPDATE
+        SET amount = recipes_shoppingcartingredient.amount
+            + EXCLUDED.amount;
+    """
+    _REMOVE_SQL = """
+        SELECT 1 FROM recipes_recipe WHERE id = ANY(%(recipes)s::bigint[])
+        FOR SHARE;
+        UPDATE recipes_shoppingcartingredient AS cart
+        SET amount = cart.amount - ri.total
+        FROM (
+            SELECT ingredient_id, SUM(amount) AS total
+            FROM recipes_recipeingredient
+            WHERE recipe_id = ANY(%(recipes)s::bigint[])
+            GROUP BY ingredient_id
+        ) AS ri
+        WHERE cart.ingredient_id = ri.ingredient_id
+            AND cart.user_id = ANY(%(users)s::bigint[]);
+        DELETE FROM recipes_shoppingcartingredient
+        WHERE user_id = ANY(%(users)s::bigint[]) AND amount <= 0;
+    """
+
+    _DELTAS_SQL = """
+        INSERT INTO recipes_shoppingcartingredient
+            (user_id, ingredient_id, amount)
+        SELECT u.id, d.ingredient_id, d.delta
+        FROM unnest(%(users)s::bigint[]) AS u(id)
+        CROSS JOIN unnest(%(ingredients)s::bigint[], %(deltas)s::integer[])
+            AS d(ingredient_id, delta)
+        ON CONFLICT (user_id, ingredient_id) DO UPDATE
+        SET amount = recipes_shoppingcartingredient.amount
+            + EXCLUDED.amount;
+        DELETE FROM recipes_shoppingcartingredient
+        WHERE user_id = ANY(%(users)s::bigint[]) AND amount <= 0;
+    """
+
+    def _apply_recipes(self, recipe_ids, user_ids, sql):
+        recipe_ids = list(recipe_ids)
+        user_ids = list(user_ids)
+        if not recipe_ids or not user_ids:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(sql, {'recipes': recipe_ids, 'users': user_ids})
+
+
+class ShoppingCartIngredient(models.Model):
+    """Сумма ингредиентов всех рецептов в корзине пользователя."""
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="shopping_cart_ingredients",
+        verbose_name="Пользователь"
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        related_name="shopping_cart_totals",
+        verbose_name="Ингредиент"
+    )
+    amount = models.IntegerField(
+        verbose_name="Количество"
+    )
+
+    objects = ShoppingCartIngredientManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "ingredient"],
+                name="unique_shopping_cart_ingredient"
+            )
+        ]
+        verbose_name = "Ингредиент в корзине"
+        verbose_name_plural = "Ингредиенты в корзинах"
+
+    def __str__(self):
+        return (
+            f"{self.user.username}: {self.ingredient.name} - {self.amount} "
+            f"{self.ingredient.measurement_unit}"
+        )
+
+
+def update_search_vectors(recipes):
+    """Пересчитать поисковый вектор: название, описание и ингредиенты."""
+    ingredient_names = RecipeIngredient.objects.filter(
+        recipe=OuterRef('pk')
+    ).values('recipe').annotate(
+        names=StringAgg('ingredient__name', ' ')
+    ).values('names')
+    recipes.update(search_vector=(
+        SearchVector('name', weight='A', config='russian')
+        + SearchVector('text', weight='B', config='russian')
+        + SearchVector(
+            Coalesce(
+                Subquery(ingredient_names), Value(''),
+                output_field=TextField()
+            ),
+            weight='C',
+            config='russian'
+        )
+    ))
+
+
+def clear_shopping_list_cache(recipe):
+    """Сбросить списки покупок всех, у кого рецепт лежит в корзине."""
+    user_ids = ShoppingCart.objects.filter(
+        recipe=recipe
+    ).values_list('user_id', flat=True)
+    bump_generations_on_commit(
+        *(f'shopping_list:{user_id}' for user_id in user_ids)
+    )
+
+
+def _recipe_amounts(recipe_ids):
+    amounts = {}
+    for recipe_id, ingredient_id, amount in RecipeIngredient.objects.filter(
+        recipe_id__in=recipe_ids
+    ).values_list('recipe_id', 'ingredient_id', 'amount'):
+        amounts.setdefault(recipe_id, {})[ingredient_id] = amount
+    return amounts
+
+
+@contextmanager
+def track_ingredient_edits(recipe_ids):
+    """Довести до конца правки ингредиентов рецептов внутри блока.
+
+    Для записи мимо RecipeCreateUpdateSerializer (админка, shell):
+    агрегат корзин получает разницу снимков ингредиентов до и после
+    блока, у изменённых рецептов пересчитывается поисковый вектор и
+    сбрасываются кеши. Рецепты на это время заблокированы, как в правке
+    через API.
+    """
+    recipe_ids = list(recipe_ids)
+    with transaction.atomic():
+        list(Recipe.objects.select_for_update().filter(
+            pk__in=recipe_ids
+        ).values_list('pk', flat=True))
+        before = _recipe_amounts(recipe_ids)
+        yield
+        after = _recipe_amounts(recipe_ids)
+        changed = []
+        for recipe_id in recipe_ids:
+            old, new = before.get(recipe_id, {}), after.get(recipe_id, {})
+            deltas = {
+                ingredient_id: new.get(ingredient_id, 0)
+                - old.get(ingredient_id, 0)
+                for ingredient_id in old.keys() | new.keys()
+                if new.get(ingredient_id) != old.get(ingredient_id)
+            }
+            if not deltas:
+                continue
+            changed.append(recipe_id)
+            ShoppingCartIngredient.objects.apply_deltas(
+                ShoppingCart.objects.filter(
+                    recipe_id=recipe_id
+                ).values_list('user_id', flat=True),
+                deltas,
+            )
+            clear_shopping_list_cache(recipe_id)
+        if changed:
+            recipes = Recipe.objects.filter(pk__in=changed)
+            update_search_vectors(recipes)
+            # Строки ингредиентов не трогают рецепт, а от updated_at
+            # зависят ETag и Last-Modified его страницы.
+            recipes.update(updated_at=timezone.now())
+            bump_generations_on_commit('recipes')
+
+
 @receiver([post_save, post_delete], sender=Recipe)
 def clear_recipe_cache(sender, instance, **kwargs):
-    cache.delete_pattern('popular_recipes*')
-    cache.delete_pattern(f'recipe_{instance.id}*')
-    cache.delete_pattern('paginated_*')
+    bump_generations_on_commit('recipes')
+
+
+@receiver([post_save, post_delete], sender=Recipe)
+def count_author_recipes(sender, instance, created=None, **kwargs):
+    # post_delete не передаёт created: None - удаление, False - правка.
+    if created is False:
+        return
+    change_counter(
+        User.objects.filter(pk=instance.author_id),
+        'recipes_count',
+        1 if created else -1
+    )
+    # Счётчик в ответах подставляется из своего кеша (api.response_cache).
+    forget_counters(User, [instance.author_id])
+
+
+@receiver(pre_save, sender=Recipe)
+def remember_recipe_image(sender, instance, update_fields=None, **kwargs):
+    remember_file(instance, 'image', update_fields)
+
+
+@receiver(post_save, sender=Recipe)
+def release_replaced_recipe_image(sender, instance, **kwargs):
+    release_replaced_file(instance, 'image')
+
+
+@receiver(post_delete, sender=Recipe)
+def release_recipe_image(sender, instance, **kwargs):
+    release_deleted_file(instance, 'image')
+
+
+@receiver(post_save, sender=Recipe)
+def update_recipe_search_vector(sender, instance, created,
+                                update_fields=None, **kwargs):
+    # Правки ингредиентов обновляют вектор сами: сериализатор API и
+    # track_ingredient_edits.
+    if created or instance.search_text_changed(update_fields):
+        update_search_vectors(Recipe.objects.filter(pk=instance.pk))
+    instance.remember_search_text()
+
+
+@receiver(post_save, sender=Ingredient)
+def update_ingredient_recipes_search_vector(sender, instance, created,
+                                            **kwargs):
+    if not created:
+        update_search_vectors(Recipe.objects.filter(ingredients=instance))
 
 
 @receiver([post_save, post_delete], sender=Ingredient)
 def clear_ingredient_cache(sender, instance, **kwargs):
-    cache.delete_pattern('ingredients*')
+    bump_generations_on_commit('ingredients', 'recipes')
+
+
+@receiver(post_save, sender=ShoppingCart)
+def add_to_cart_totals(sender, instance, created, **kwargs):
+    if created:
+        ShoppingCartIngredient.objects.add_recipe(
+            instance.recipe_id, [instance.user_id]
+        )
+
+
+@receiver(pre_delete, sender=ShoppingCart)
+def remove_from_cart_totals(sender, instance, **kwargs):
+    # pre_delete: при каскадном удалении рецепта его ингредиенты
+    # ещё на месте.
+    ShoppingCartIngredient.objects.remove_recipe(
+        instance.recipe_id, [instance.user_id]
+    )
+
+
+def favorites_changed(user_id, recipe_ids, delta):
+    """Счётчики и кеш после изменения избранного пользователя."""
+    change_counter(
+        Recipe.objects.filter(pk__in=recipe_ids), 'favorites_count', delta
+    )
+    # Общие шаблоны списков не сбрасываются: счётчики в них - метки,
+    # а флаги зрителя зависят от его поколения.
+    forget_counters(Recipe, recipe_ids)
+    # Поколение зрителя сдвигает viewer_set_changed после коммита.
+    viewer_set_changed(user_id, FAVORITE, recipe_ids, delta)
+
+
+def carts_changed(user_id, recipe_ids, delta):
+    """Счётчики и кеш после изменения корзины пользователя."""
+    change_counter(
+        Recipe.objects.filter(pk__in=recipe_ids), 'in_carts_count', delta
+    )
+    forget_counters(Recipe, recipe_ids)
+    bump_generations_on_commit(f'shopping_list:{user_id}')
+    viewer_set_changed(user_id, SHOPPING_CART, recipe_ids, delta)
+
+
+@receiver([post_save, post_delete], sender=Favorite)
+def count_favorites(sender, instance, created=None, **kwargs):
+    if created is False:
+        return
+    favorites_changed(
+        instance.user_id, [instance.recipe_id], 1 if created else -1
+    )
+
+
+@receiver([post_save, post_delete], sender=ShoppingCart)
+def count_carts(sender, instance, created=None, **kwargs):
+    if created is False:
+        return
+    carts_changed(
+        instance.user_id, [instance.recipe_id], 1 if created else -1
+    )
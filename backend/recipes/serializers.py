@@ -1,9 +1,16 @@
-from foodgram_api.image_field import Base64ImageField
+from api.viewer_state import CounterField, get_viewer_state
+from core.cache import bump_generations_on_commit
+from core.counters import change_counter, forget_counters
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+from foodgram_api.image_field import Base64ImageField, ImageVariantField
+from foodgram_api.images import RECIPE_IMAGE_VARIANTS, schedule_image_variants
 from rest_framework import serializers
 from users.models import User
 
 from .models import (Favorite, Ingredient, Recipe, RecipeIngredient,
-                     ShoppingCart)
+                     ShoppingCart, ShoppingCartIngredient, clear_recipe_cache,
+                     clear_shopping_list_cache, update_search_vectors)
 
 
 class IngredientSerializer(serializers.ModelSerializer):
@@ -34,11 +41,23 @@ class IngredientInRecipeSerializer(serializers.ModelSerializer):
 
 
 class RecipeMinifiedSerializer(serializers.ModelSerializer):
+    image = ImageVariantField('card')
+
     class Meta:
         model = Recipe
         fields = ("id", "name", "image", "cooking_time")
 
 
+class RecipeListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        recipes = list(data.all() if hasattr(data, 'all') else data)
+        get_viewer_state(self.context).prime(
+            recipe_ids=[recipe.id for recipe in recipes],
+            author_ids=[recipe.author_id for recipe in recipes],
+        )
+        return super().to_representation(recipes)
+
+
 class RecipeSerializer(serializers.ModelSerializer):
     author = serializers.SerializerMethodField()
     ingredients = IngredientInRecipeSerializer(
@@ -48,6 +67,9 @@ class RecipeSerializer(serializers.ModelSerializer):
     )
     is_favorited = serializers.SerializerMethodField()
     is_in_shopping_cart = serializers.SerializerMethodField()
+    image = ImageVariantField('detail', list_variant='card')
+    favorites_count = CounterField()
+    in_carts_count = CounterField()
 
     class Meta:
         model = Recipe
@@ -61,32 +83,121 @@ class RecipeSerializer(serializers.ModelSerializer):
             "image",
             "text",
             "cooking_time",
+            "favorites_count",
+            "in_carts_count",
         )
+        list_serializer_class = RecipeListSerializer
 
     def get_author(self, obj):
-        from users.serializers import UserSerializer
-        return UserSerializer(obj.author, context=self.context).data
+        authors = self.context.setdefault('authors', {})
+        if obj.author_id not in authors:
+            from users.serializers import UserSerializer
+            authors[obj.author_id] = UserSerializer(
+                obj.author, context=self.context
+            ).data
+        return authors[obj.author_id]
 
     def get_is_favorited(self, obj):
-        user = self.context.get("request").user
-        if user.is_authenticated:
-            return obj.favorited_by.filter(user=user).exists()
-        return False
+        return get_viewer_state(self.context).is_favorited(obj)
 
     def get_is_in_shopping_cart(self, obj):
-        user = self.context.get("request").user
-        if user.is_authenticated:
-            return obj.in_shopping_carts.filter(user=user).exists()
-        return False
+        return get_viewer_state(self.context).is_in_shopping_cart(obj)
+
+
+def ingredient_ids(items):
+    """Все похожие на id значения из сырого списка ингредиентов."""
+    ids = set()
+    for item in items if isinstance(items, list) else ():
+        try:
+            ids.add(int(item["id"]))
+        except (KeyError, TypeError, ValueError):
+            pass
+    return ids
+
+
+class RecipeIngredientListSerializer(serializers.ListSerializer):
+    """Ингредиенты рецепта: все id проверяются одним запросом IN."""
+
+    def to_internal_value(self, data):
+        items = super().to_internal_value(data)
+        # Массовый импорт загружает ингредиенты всех рецептов заранее.
+        ingredients = self.context.get("ingredient_catalogue")
+        if ingredients is None:
+            ingredients = Ingredient.objects.in_bulk(
+                {item["id"] for item in items}
+            )
+        message = serializers.PrimaryKeyRelatedField.default_error_messages[
+            "does_not_exist"
+        ]
+        errors = [
+            {} if item["id"] in ingredients
+            else {"id": [str(message).format(pk_value=item["id"])]}
+            for item in items
+        ]
+        if any(errors):
+            raise serializers.ValidationError(errors, code="does_not_exist")
+        for item in items:
+            item["id"] = ingredients[item["id"]]
+        return items
 
 
 class RecipeIngredientCreateSerializer(serializers.ModelSerializer):
-    id = serializers.PrimaryKeyRelatedField(queryset=Ingredient.objects.all())
+    id = serializers.IntegerField()
     amount = serializers.IntegerField(min_value=1)
 
     class Meta:
         model = RecipeIngredient
         fields = ("id", "amount")
+        list_serializer_class = RecipeIngredientListSerializer
+
+
+class RecipeImportSerializer(serializers.ListSerializer):
+    """Массовое создание рецептов за фиксированное число запросов."""
+
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            ids = set()
+            for recipe in data:
+                if isinstance(recipe, dict):
+                    ids |= ingredient_ids(recipe.get("ingredients"))
+            self.context["ingredient_catalogue"] = (
+                Ingredient.objects.in_bulk(ids)
+            )
+        return super().to_internal_value(data)
+
+    @transaction.atomic
+    def create(self, validated_data):
+        # bulk_create не шлёт сигналы: счётчик автора, поисковые векторы
+        # и поколения кеша обновляются здесь же.
+        author = self.context["request"].user
+        ingredients_data = [
+            item.pop("ingredients") for item in validated_data
+        ]
+        recipes = Recipe.objects.bulk_create([
+            Recipe(**{**item, "author": author}) for item in validated_data
+        ])
+        RecipeIngredient.objects.bulk_create([
+            RecipeIngredient(
+                recipe=recipe,
+                ingredient=item["id"],
+                amount=item["amount"],
+            )
+            for recipe, items in zip(recipes, ingredients_data)
+            for item in items
+        ])
+        update_search_vectors(
+            Recipe.objects.filter(pk__in=[recipe.pk for recipe in recipes])
+        )
+        change_counter(
+            User.objects.filter(pk=author.pk), "recipes_count", len(recipes)
+        )
+        forget_counters(User, [author.pk])
+        bump_generations_on_commit("recipes")
+        for recipe in recipes:
+            schedule_image_variants(
+                recipe.image, RECIPE_IMAGE_VARIANTS, ("recipes",)
+            )
+        return recipes
 
 
 class RecipeCreateUpdateSerializer(serializers.ModelSerializer):
@@ -96,7 +207,9 @@ class RecipeCreateUpdateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Recipe
         fields = ("ingredients", "image", "name", "text", "cooking_time")
+        list_serializer_class = RecipeImportSerializer
 
+    @transaction.atomic
     def create(self, validated_data):
         ingredients_data = validated_data.pop("ingredients")
         validated_data.pop('author', None)
@@ -105,16 +218,94 @@ class RecipeCreateUpdateSerializer(serializers.ModelSerializer):
             **validated_data
         )
         self._add_ingredients(recipe, ingredients_data)
+        update_search_vectors(Recipe.objects.filter(pk=recipe.pk))
+        get_viewer_state(self.context).mark(recipe)
+        schedule_image_variants(
+            recipe.image, RECIPE_IMAGE_VARIANTS, ('recipes',)
+        )
         return recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
         ingredients_data = validated_data.pop("ingredients", None)
+        # Ингредиенты - до сохранения рецепта: при новых названии или
+        # описании вектор один раз пересчитает сигнал post_save.
+        text_changed = any(
+            field in validated_data
+            and validated_data[field] != getattr(instance, field)
+            for field in Recipe.SEARCH_FIELDS
+        )
+        ingredients_changed = (
+            ingredients_data is not None
+            and self._update_ingredients(instance, ingredients_data)
+        )
         instance = super().update(instance, validated_data)
-        if ingredients_data is not None:
-            instance.recipe_ingredients.all().delete()
-            self._add_ingredients(instance, ingredients_data)
+        if 'image' in validated_data:
+            schedule_image_variants(
+                instance.image, RECIPE_IMAGE_VARIANTS, ('recipes',)
+            )
+        if ingredients_changed:
+            if not text_changed:
+                update_search_vectors(Recipe.objects.filter(pk=instance.pk))
+            clear_shopping_list_cache(instance)
+            clear_recipe_cache(Recipe, instance)
         return instance
 
+    def _update_ingredients(self, recipe, ingredients_data):
+        """Применить к ингредиентам только разницу; вернуть, было ли что.
+
+        Изменённые количества - одним bulk_update, новые - одним
+        bulk_create, убранные - одним DELETE. Агрегаты корзин получают
+        ту же разницу.
+        """
+        Recipe.objects.select_for_update().filter(pk=recipe.pk).exists()
+        existing = {
+            item.ingredient_id: item
+            for item in RecipeIngredient.objects.filter(recipe=recipe)
+        }
+        amounts = {
+            item["id"].id: item["amount"] for item in ingredients_data
+        }
+        removed = existing.keys() - amounts.keys()
+        added = [
+            item for item in ingredients_data
+            if item["id"].id not in existing
+        ]
+        changed = [
+            item for ingredient_id, item in existing.items()
+            if ingredient_id in amounts
+            and item.amount != amounts[ingredient_id]
+        ]
+        if not removed and not added and not changed:
+            return False
+
+        deltas = {ingredient_id: -existing[ingredient_id].amount
+                  for ingredient_id in removed}
+        deltas.update(
+            (item["id"].id, item["amount"]) for item in added
+        )
+        for item in changed:
+            deltas[item.ingredient_id] = (
+                amounts[item.ingredient_id] - item.amount
+            )
+            item.amount = amounts[item.ingredient_id]
+
+        if removed:
+            RecipeIngredient.objects.filter(
+                recipe=recipe, ingredient_id__in=removed
+            ).delete()
+        if changed:
+            RecipeIngredient.objects.bulk_update(changed, ["amount"])
+        if added:
+            self._add_ingredients(recipe, added)
+        ShoppingCartIngredient.objects.apply_deltas(
+            ShoppingCart.objects.filter(
+                recipe=recipe
+            ).values_list('user_id', flat=True),
+            deltas,
+        )
+        return True
+
     def _add_ingredients(self, recipe, ingredients_data):
         RecipeIngredient.objects.bulk_create([
             RecipeIngredient(
@@ -150,6 +341,8 @@ class RecipeCreateUpdateSerializer(serializers.ModelSerializer):
         return data
 
     def to_representation(self, instance):
+        # Ингредиенты с названиями одним запросом, а не по одному.
+        prefetch_related_objects([instance], "recipe_ingredients__ingredient")
         return RecipeSerializer(instance, context=self.context).data
 
 
@@ -160,39 +353,6 @@ class ShoppingCartSerializer(serializers.ModelSerializer):
         fields = "__all__"
 
 
-class FollowSerializer(serializers.ModelSerializer):
-    recipes = serializers.SerializerMethodField()
-    recipes_count = serializers.SerializerMethodField()
-    is_subscribed = serializers.SerializerMethodField()
-    avatar = Base64ImageField(read_only=True)
-
-    class Meta:
-        model = User
-        fields = (
-            "email", "id", "username", "first_name", "last_name",
-            "is_subscribed", "recipes", "recipes_count", "avatar",
-        )
-
-    def get_is_subscribed(self, obj):
-        user = self.context.get("request").user
-        if user.is_authenticated:
-            if obj.follower.filter(user=user).exists():
-                return True
-        return False
-
-    def get_recipes(self, obj):
-        limit = self.context.get("recipes_limit")
-        queryset = obj.recipes.all()
-        if limit and limit.isdigit():
-            queryset = queryset[:int(limit)]
-        return RecipeMinifiedSerializer(queryset,
-                                        many=True,
-                                        context=self.context).data
-
-    def get_recipes_count(self, obj):
-        return obj.recipes.count()
-
-
 class FavoriteSerializer(serializers.ModelSerializer):
     class Meta:
         model = Favorite
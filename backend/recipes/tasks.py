@@ -0,0 +1,23 @@
+from core.tasks import task
+from django.conf import settings
+from django.contrib.auth import get_user_model
+
+from .utils import prerender_shopping_list, render_shopping_list
+
+User = get_user_model()
+
+
+@task
+def render_shopping_lists(user_id):
+    """Заранее собрать файлы списка покупок после изменения корзины."""
+    user = User.objects.filter(pk=user_id).first()
+    if user is None or not user.shopping_cart_ingredients.exists():
+        return
+    for file_format in settings.SHOPPING_LIST_PRERENDER_FORMATS:
+        prerender_shopping_list(user, file_format)
+
+
+@task
+def render_shopping_list_file(user_id, file_format):
+    """Собрать файл списка покупок для запроса, ждущего через call."""
+    return render_shopping_list(User.objects.get(pk=user_id), file_format)
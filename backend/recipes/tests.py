@@ -0,0 +1,419 @@
+import random
+from io import BytesIO
+
+import pytest
+from core.cache import get_generation
+from core.counters import change_counter
+from core.tasks import claim
+from django.contrib.postgres.search import SearchQuery
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from foodgram_api.images import generate_image_variants, variant_url
+from PIL import Image
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from users.models import Follow, User
+
+from .models import (Ingredient, Recipe, RecipeIngredient, ShoppingCart,
+                     ShoppingCartIngredient, track_ingredient_edits)
+from .serializers import RecipeCreateUpdateSerializer
+
+
+def edit_ingredients(recipe, amounts, **fields):
+    """Заменить ингредиенты рецепта так же, как PATCH /api/recipes/<id>/."""
+    request = Request(APIRequestFactory().patch('/'))
+    request.user = recipe.author
+    serializer = RecipeCreateUpdateSerializer(
+        recipe,
+        data={'ingredients': [
+            {'id': ingredient_id, 'amount': amount}
+            for ingredient_id, amount in amounts.items()
+        ], **fields},
+        partial=True,
+        context={'request': request},
+    )
+    assert serializer.is_valid(), serializer.errors
+    serializer.save()
+
+
+@pytest.fixture
+def ingredients(db):
+    return Ingredient.objects.bulk_create(
+        Ingredient(name=f'ingredient {i}', measurement_unit='г')
+        for i in range(10)
+    )
+
+
+@pytest.fixture
+def make_recipe_with(make_recipe):
+    def make_recipe_with(name, amounts):
+        recipe = make_recipe(name)
+        RecipeIngredient.objects.bulk_create(
+            RecipeIngredient(
+                recipe=recipe, ingredient_id=ingredient_id, amount=amount
+            )
+            for ingredient_id, amount in amounts.items()
+        )
+        return recipe
+    return make_recipe_with
+
+
+def vector_updates(context):
+    return [
+        query['sql'] for query in context.captured_queries
+        if query['sql'].startswith('UPDATE')
+        and 'search_vector' in query['sql']
+    ]
+
+
+def matches(recipe, word):
+    return Recipe.objects.filter(
+        pk=recipe.pk, search_vector=SearchQuery(word, config='russian')
+    ).exists()
+
+
+def cart_totals(user):
+    return dict(ShoppingCartIngredient.objects.filter(
+        user=user
+    ).values_list('ingredient_id', 'amount'))
+
+
+def test_ingredient_edit_applies_diff_to_carts(
+    make_user, make_recipe_with, ingredients
+):
+    salt, flour, sugar, milk = (item.pk for item in ingredients[:4])
+    recipe = make_recipe_with('pancakes', {salt: 5, flour: 200, sugar: 30})
+    other = make_recipe_with('bread', {flour: 500})
+    buyer, both, outsider = (
+        make_user('buyer'), make_user('both'), make_user('outsider')
+    )
+    ShoppingCart.objects.add_many(buyer.pk, [recipe.pk])
+    ShoppingCart.objects.add_many(both.pk, [recipe.pk, other.pk])
+    ShoppingCart.objects.add_many(outsider.pk, [other.pk])
+    untouched = list(RecipeIngredient.objects.filter(
+        recipe=recipe, ingredient_id=salt
+    ).values_list('pk', flat=True))
+
+    # Соль без изменений, мука меняется, сахар убран, молоко добавлено.
+    edit_ingredients(recipe, {salt: 5, flour: 250, milk: 100})
+
+    assert dict(recipe.recipe_ingredients.values_list(
+        'ingredient_id', 'amount'
+    )) == {salt: 5, flour: 250, milk: 100}
+    # Неизменённая строка не пересоздаётся.
+    assert list(RecipeIngredient.objects.filter(
+        recipe=recipe, ingredient_id=salt
+    ).values_list('pk', flat=True)) == untouched
+    assert cart_totals(buyer) == {salt: 5, flour: 250, milk: 100}
+    assert cart_totals(both) == {salt: 5, flour: 750, milk: 100}
+    assert cart_totals(outsider) == {flour: 500}
+    assert ShoppingCartIngredient.objects.mismatches() == {}
+
+
+def test_ingredient_edit_without_changes_writes_nothing(
+    make_user, make_recipe_with, ingredients
+):
+    salt, flour = (ingredient.pk for ingredient in ingredients[:2])
+    recipe = make_recipe_with('pancakes', {salt: 5, flour: 200})
+    ShoppingCart.objects.add_many(make_user('buyer').pk, [recipe.pk])
+
+    with CaptureQueriesContext(connection) as context:
+        edit_ingredients(recipe, {flour: 200, salt: 5})
+
+    writes = [
+        query['sql'] for query in context.captured_queries
+        for model in (RecipeIngredient, ShoppingCartIngredient)
+        if query['sql'].startswith((
+            f'INSERT INTO "{model._meta.db_table}"',
+            f'UPDATE "{model._meta.db_table}"',
+            f'DELETE FROM "{model._meta.db_table}"',
+        ))
+    ]
+    assert writes == []
+
+
+def test_admin_inline_edit_updates_cart_totals(
+    client, make_user, make_recipe_with, ingredients
+):
+    salt, flour = (item.pk for item in ingredients[:2])
+    cinnamon = Ingredient.objects.create(
+        name='корица', measurement_unit='г'
+    ).pk
+    recipe = make_recipe_with('pancakes', {salt: 5, flour: 200})
+    buyer = make_user('buyer')
+    ShoppingCart.objects.add_many(buyer.pk, [recipe.pk])
+    admin = make_user('admin')
+    admin.is_staff = admin.is_superuser = True
+    admin.save()
+    client.force_login(admin)
+    salt_row, flour_row = recipe.recipe_ingredients.order_by('ingredient')
+
+    prefix = 'recipe_ingredients'
+    response = client.post(f'/admin/recipes/recipe/{recipe.pk}/change/', {
+        'name': recipe.name,
+        'text': recipe.text,
+        'author': recipe.author_id,
+        'cooking_time': recipe.cooking_time,
+        f'{prefix}-TOTAL_FORMS': 3,
+        f'{prefix}-INITIAL_FORMS': 2,
+        f'{prefix}-0-id': salt_row.pk,
+        f'{prefix}-0-recipe': recipe.pk,
+        f'{prefix}-0-ingredient': salt,
+        f'{prefix}-0-amount': 5,
+        f'{prefix}-0-DELETE': 'on',
+        f'{prefix}-1-id': flour_row.pk,
+        f'{prefix}-1-recipe': recipe.pk,
+        f'{prefix}-1-ingredient': flour,
+        f'{prefix}-1-amount': 300,
+        f'{prefix}-2-recipe': recipe.pk,
+        f'{prefix}-2-ingredient': cinnamon,
+        f'{prefix}-2-amount': 40,
+    })
+
+    assert response.status_code == 302
+    assert cart_totals(buyer) == {flour: 300, cinnamon: 40}
+    # Вектор собран после сохранения инлайна, с новыми ингредиентами.
+    assert matches(recipe, 'корица')
+    assert ShoppingCartIngredient.objects.mismatches() == {}
+
+
+def test_track_ingredient_edits_covers_orm_edits(
+    make_user, make_recipe_with, ingredients
+):
+    salt, flour = (item.pk for item in ingredients[:2])
+    recipe = make_recipe_with('pancakes', {salt: 5})
+    other = make_recipe_with('bread', {salt: 10})
+    buyer = make_user('buyer')
+    ShoppingCart.objects.add_many(buyer.pk, [recipe.pk, other.pk])
+
+    with track_ingredient_edits([recipe.pk]):
+        recipe.recipe_ingredients.update(amount=7)
+        RecipeIngredient.objects.create(
+            recipe=recipe, ingredient_id=flour, amount=100
+        )
+
+    assert cart_totals(buyer) == {salt: 17, flour: 100}
+    assert ShoppingCartIngredient.objects.mismatches() == {}
+
+
+def test_recipe_save_skips_search_vector_without_text_changes(
+    make_recipe_with, ingredients
+):
+    recipe = Recipe.objects.get(
+        pk=make_recipe_with('pancakes', {ingredients[0].pk: 5}).pk
+    )
+    recipe.cooking_time = 20
+    with CaptureQueriesContext(connection) as context:
+        recipe.save()
+    assert vector_updates(context) == []
+
+    recipe.name = 'блины'
+    with CaptureQueriesContext(connection) as context:
+        recipe.save()
+        recipe.save()
+    assert len(vector_updates(context)) == 1
+    assert matches(recipe, 'блины')
+
+
+def test_recipe_save_bumps_generation_after_commit(
+    make_recipe, django_capture_on_commit_callbacks
+):
+    recipe = make_recipe('pancakes')
+    generation = get_generation('recipes')
+    with django_capture_on_commit_callbacks(execute=True):
+        recipe.save()
+        # До коммита читатель видит старые данные и старое поколение.
+        assert get_generation('recipes') == generation
+    assert get_generation('recipes') != generation
+
+
+def test_full_save_keeps_concurrent_counter_changes(make_recipe):
+    recipe = make_recipe('pancakes')
+    author = User.objects.get(pk=recipe.author_id)
+    # Другой запрос меняет счётчики между чтением и сохранением.
+    change_counter(Recipe.objects.filter(pk=recipe.pk), 'favorites_count', 1)
+    change_counter(User.objects.filter(pk=author.pk), 'followers_count', 1)
+
+    recipe.name = 'блины'
+    recipe.save()
+    author.first_name = 'Повар'
+    author.save()
+
+    recipe.refresh_from_db()
+    author.refresh_from_db()
+    assert (recipe.name, recipe.favorites_count) == ('блины', 1)
+    assert (author.first_name, author.followers_count) == ('Повар', 1)
+
+
+def test_ingredient_and_name_edit_builds_search_vector_once(
+    make_recipe_with, ingredients
+):
+    recipe = make_recipe_with('pancakes', {ingredients[0].pk: 5})
+    cinnamon = Ingredient.objects.create(name='корица', measurement_unit='г')
+
+    with CaptureQueriesContext(connection) as context:
+        edit_ingredients(recipe, {cinnamon.pk: 3}, name='блины')
+
+    assert len(vector_updates(context)) == 1
+    assert matches(recipe, 'блины') and matches(recipe, 'корица')
+
+
+def test_pdf_download_without_task_worker(
+    settings, task_queue, make_user, make_recipe_with, ingredients
+):
+    settings.SHOPPING_LIST_PDF_PICKUP_TIMEOUT = 0.1
+    # Задача попадает в очередь, но воркеров нет.
+    recipe = make_recipe_with('pancakes', {ingredients[0].pk: 5})
+    buyer = make_user('buyer')
+    ShoppingCart.objects.add_many(buyer.pk, [recipe.pk])
+    client = APIClient()
+    client.force_authenticate(buyer)
+
+    response = client.get('/api/recipes/download_shopping_cart/?format=pdf')
+
+    assert response.status_code == 200
+    assert b''.join(response.streaming_content).startswith(b'%PDF')
+    # Файл собрал сам запрос: воркер, взявший задачу позже, её пропустит.
+    message, = task_queue
+    assert message['task'].endswith('render_shopping_list_file')
+    assert not claim(message)
+
+
+@pytest.fixture
+def stored_image(settings, tmp_path):
+    settings.MEDIA_ROOT = tmp_path
+    buffer = BytesIO()
+    Image.new('RGB', (1600, 1200), 'orange').save(buffer, 'PNG')
+    return default_storage.save(
+        'recipes/cake.png', ContentFile(buffer.getvalue())
+    )
+
+
+def test_variant_url_does_not_touch_storage(
+    monkeypatch, make_recipe, stored_image
+):
+    recipe = make_recipe('cake')
+    recipe.image = stored_image
+    recipe.save()
+
+    def render():
+        with monkeypatch.context() as patch:
+            patch.setattr(default_storage, 'exists', pytest.fail)
+            return variant_url(recipe.image, 'detail')
+
+    assert render() == '/media/recipes/cake.png'
+    generate_image_variants(stored_image, ['detail'])
+    assert render() == '/media/recipes/cake_detail.webp'
+    assert default_storage.exists('recipes/cake_detail.webp')
+
+
+def test_recipe_etag_changes_when_image_variant_is_ready(
+    make_recipe, stored_image
+):
+    recipe = make_recipe('cake')
+    recipe.image = stored_image
+    recipe.save()
+    client = APIClient()
+    url = f'/api/recipes/{recipe.pk}/'
+    etag = client.get(url)['ETag']
+    assert client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == 304
+
+    generate_image_variants(stored_image, ['detail'])
+
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response.data['image'].endswith('/cake_detail.webp')
+    assert response['ETag'] != etag
+
+
+def test_recipe_etag_follows_author_counters_and_ingredients(
+    make_user, make_recipe_with, ingredients,
+    django_capture_on_commit_callbacks
+):
+    recipe = make_recipe_with('pancakes', {ingredients[0].pk: 5})
+    client = APIClient()
+    url = f'/api/recipes/{recipe.pk}/'
+    etag = client.get(url)['ETag']
+
+    with django_capture_on_commit_callbacks(execute=True):
+        Follow.objects.add_many(make_user('fan').pk, [recipe.author_id])
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response.data['author']['followers_count'] == 1
+
+    etag = response['ETag']
+    with track_ingredient_edits([recipe.pk]):
+        recipe.recipe_ingredients.update(amount=7)
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response.data['ingredients'][0]['amount'] == 7
+
+
+def test_ingredient_etag_does_not_hide_missing_ingredient(ingredients):
+    client = APIClient()
+    etag = client.get(f'/api/ingredients/{ingredients[0].pk}/')['ETag']
+    assert client.get(
+        f'/api/ingredients/{ingredients[0].pk}/', HTTP_IF_NONE_MATCH=etag
+    ).status_code == 304
+    missing = f'/api/ingredients/{ingredients[-1].pk + 1000}/'
+    assert client.get(
+        missing, HTTP_IF_NONE_MATCH=etag
+    ).status_code == 404
+    # ETag одного ингредиента не подходит другому.
+    assert client.get(
+        f'/api/ingredients/{ingredients[1].pk}/', HTTP_IF_NONE_MATCH=etag
+    ).status_code == 200
+
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_shopping_cart_totals_survive_random_changes(
+    seed, make_user, make_recipe_with, ingredients
+):
+    rng = random.Random(seed)
+    ingredient_ids = [ingredient.pk for ingredient in ingredients]
+    users = [make_user(f'user-{i}') for i in range(4)]
+    recipes = [
+        make_recipe_with(f'recipe-{i}', {
+            ingredient_id: rng.randint(1, 500)
+            for ingredient_id in rng.sample(ingredient_ids, 3)
+        })
+        for i in range(6)
+    ]
+
+    for step in range(150):
+        user = rng.choice(users)
+        picked = rng.sample(recipes, rng.randint(1, 3))
+        choice = rng.random()
+        if choice < 0.2:
+            # Путь сигналов: одна корзина через ORM.
+            ShoppingCart.objects.get_or_create(user=user, recipe=picked[0])
+        elif choice < 0.35:
+            for cart in ShoppingCart.objects.filter(
+                user=user, recipe=picked[0]
+            ):
+                cart.delete()
+        elif choice < 0.55:
+            # Путь эндпоинтов: ShoppingCartManager и changed().
+            ShoppingCart.objects.add_many(
+                user.pk, [recipe.pk for recipe in picked]
+            )
+        elif choice < 0.75:
+            ShoppingCart.objects.remove_many(
+                user.pk, [recipe.pk for recipe in picked]
+            )
+        else:
+            recipe = picked[0]
+            amounts = {
+                item.ingredient_id: (
+                    rng.randint(1, 500) if rng.random() < 0.5
+                    else item.amount
+                )
+                for item in recipe.recipe_ingredients.all()
+                if rng.random() < 0.7
+            }
+            for ingredient_id in rng.sample(ingredient_ids, 2):
+                amounts.setdefault(ingredient_id, rng.randint(1, 500))
+            edit_ingredients(recipe, amounts)
+        assert ShoppingCartIngredient.objects.mismatches() == {}, step
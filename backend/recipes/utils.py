@@ -1,31 +1,132 @@
-from django.core.cache import cache
-from django.db.models import Sum
-
-from .models import RecipeIngredient
-
-
-def generate_shopping_list(user):
-    cache_key = f"shopping_list_{user.id}"
-    shopping_list = cache.get(cache_key)
-
-    if not shopping_list:
-        ingredients = RecipeIngredient.objects.filter(
-            recipe__in_shopping_carts__user=user
-        ).select_related('ingredient').values(
-            'ingredient__name',
-            'ingredient__measurement_unit'
-        ).annotate(
-            total_amount=Sum('amount')
-        ).order_by('ingredient__name')
-
-        shopping_list = ["Список покупок:\n"]
-        shopping_list.extend(
-            f"""{item['ingredient__name']} - {item['total_amount']}
-            {item['ingredient__measurement_unit']}"""
-            for item in ingredients
-        )
-        shopping_list.append("\nFoodgram - Ваш кулинарный помощник!")
-        shopping_list = '\n'.join(shopping_list)
-        cache.set(cache_key, shopping_list, timeout=60 * 60)  # 1 час
-
-    return shopping_list
+import csv
+import io
+import os
+
+from core.cache import get_or_compute
+from django.conf import settings
+
+from .models import ShoppingCartIngredient
+
+TITLE = 'Список покупок'
+FOOTER = 'Foodgram - Ваш кулинарный помощник!'
+CSV_HEADER = ('Ингредиент', 'Единица измерения', 'Количество')
+CHUNK_SIZE = 64 * 1024
+
+
+def shopping_list_rows(user):
+    """Строки списка покупок: название, единица измерения, количество."""
+    return ShoppingCartIngredient.objects.filter(
+        user=user
+    ).values_list(
+        'ingredient__name',
+        'ingredient__measurement_unit',
+        'amount',
+    ).order_by('ingredient__name')
+
+
+def render_txt(rows):
+    yield f'{TITLE}:\n\n'.encode()
+    for name, measurement_unit, amount in rows:
+        yield f'• {name} ({measurement_unit}) — {amount}\n'.encode()
+    yield f'\n{FOOTER}\n'.encode()
+
+
+def render_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM нужен, чтобы Excel открыл кириллицу в UTF-8.
+    buffer.write('\ufeff')
+    writer.writerow(CSV_HEADER)
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def render_pdf(rows, font_path=None):
+    """Собрать PDF; из запроса вызывается через воркер задач."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import mm
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.pdfgen import canvas
+
+    font = 'Helvetica'
+    if font_path and os.path.exists(font_path):
+        pdfmetrics.registerFont(TTFont('ShoppingList', font_path))
+        font = 'ShoppingList'
+
+    buffer = io.BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=A4)
+    pdf.setTitle(TITLE)
+    width, height = A4
+    margin = 20 * mm
+    line_height = 7 * mm
+    y = height - margin
+
+    pdf.setFont(font, 16)
+    pdf.drawString(margin, y, TITLE)
+    y -= 2 * line_height
+    pdf.setFont(font, 12)
+    for name, measurement_unit, amount in rows:
+        if y < margin + line_height:
+            pdf.showPage()
+            pdf.setFont(font, 12)
+            y = height - margin
+        pdf.drawString(margin, y, f'• {name} ({measurement_unit})')
+        pdf.drawRightString(width - margin, y, str(amount))
+        y -= line_height
+    pdf.setFont(font, 10)
+    pdf.drawString(margin, margin / 2, FOOTER)
+    pdf.save()
+    return buffer.getvalue()
+
+
+def _render_pdf(rows):
+    yield render_pdf(list(rows), settings.SHOPPING_LIST_PDF_FONT)
+
+
+EXPORT_FORMATS = {
+    'txt': ('text/plain; charset=utf-8', render_txt),
+    'csv': ('text/csv; charset=utf-8', render_csv),
+    'pdf': ('application/pdf', _render_pdf),
+}
+
+
+def chunked(content):
+    """Отдать готовый файл кусками для StreamingHttpResponse."""
+    for start in range(0, len(content), CHUNK_SIZE):
+        yield content[start:start + CHUNK_SIZE]
+
+
+def render_shopping_list(user, file_format):
+    """Собрать файл списка покупок целиком в этом процессе."""
+    _, render = EXPORT_FORMATS[file_format]
+    return b''.join(render(shopping_list_rows(user).iterator()))
+
+
+def cached_shopping_list(user, file_format, render, local=True):
+    """Файл списка покупок из кеша; render собирает его при промахе.
+
+    Запись устаревает со сдвигом поколения корзины пользователя, поэтому
+    повторные скачивания не пересобирают файл, пока корзина не изменится.
+    """
+    return get_or_compute(
+        f'shopping_list:{user.id}:{file_format}',
+        render,
+        settings.SHOPPING_LIST_TTL,
+        (f'shopping_list:{user.id}',),
+        local=local,
+    )
+
+
+def prerender_shopping_list(user, file_format):
+    """Собрать файл и положить в кеш заранее, вне запроса."""
+    # Воркер задач не отдаёт файлы сам: локальный уровень ему не нужен.
+    cached_shopping_list(
+        user, file_format,
+        lambda: render_shopping_list(user, file_format),
+        local=False,
+    )
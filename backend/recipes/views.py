@@ -1,133 +1,228 @@
-from api.paginations import CustomPagination
+from api.bulk import change_relations, has_changes, parse_pk
+from api.conditional import ConditionalGetMixin, conditional
+from api.paginations import (CursorPaginationMixin, CustomPagination,
+                             RecipeCursorPagination)
 from api.permissions import IsAuthorOrReadOnly
-from django.core.cache import cache
-from django.http import Http404, HttpResponse, HttpResponseRedirect
+from api.response_cache import ResponseCacheMixin, UncacheableResponseError
+from core.cache import get_or_compute
+from core.counters import counters_namespace
+from core.tasks import TaskFailedError
+from django.conf import settings
+from django.http import (Http404, HttpResponse, HttpResponseRedirect,
+                         StreamingHttpResponse)
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
 from django_filters.rest_framework import DjangoFilterBackend
+from foodgram_api.images import variant_name, variant_ready
 from recipes.models import Favorite, Ingredient, Recipe, ShoppingCart
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
+from users.models import User
 
 from .filters import IngredientFilter, RecipeFilter
+from .ingredient_index import ingredient_index
 from .serializers import (IngredientSerializer, RecipeCreateUpdateSerializer,
                           RecipeMinifiedSerializer, RecipeSerializer)
-from .utils import generate_shopping_list
+from .tasks import render_shopping_list_file, render_shopping_lists
+from .utils import (EXPORT_FORMATS, cached_shopping_list, chunked,
+                    render_shopping_list)
 
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(ConditionalGetMixin, ResponseCacheMixin,
+                    CursorPaginationMixin, viewsets.ModelViewSet):
     pagination_class = CustomPagination
+    cursor_pagination_class = RecipeCursorPagination
+    # Поиск сортирует по релевантности, а курсор - по дате.
+    cursor_skip_params = ('search',)
+    response_cache_namespace = 'recipes'
+    response_cache_skip_params = ('is_favorited', 'is_in_shopping_cart')
     permission_classes = [IsAuthorOrReadOnly]
     filter_backends = [DjangoFilterBackend]
     filterset_class = RecipeFilter
     queryset = Recipe.objects.prefetch_related(
         'recipe_ingredients__ingredient',
-        'favorited_by',
-        'in_shopping_carts'
-    ).select_related('author')
+    ).select_related('author').defer('search_vector')
 
     def get_serializer_class(self):
-        if self.action in ['create', 'update', 'partial_update']:
+        if self.action in [
+            'create', 'update', 'partial_update', 'import_recipes'
+        ]:
             return RecipeCreateUpdateSerializer
         return RecipeSerializer
 
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
 
-    def get_serializer_context(self):
-        context = super().get_serializer_context()
-        user = self.request.user
-        if not user.is_authenticated:
-            context.update({
-                'favorited_ids': set(),
-                'shopping_cart_ids': set()
-            })
-            return context
-
-        favorites = set(Favorite.objects.filter(
-            user=user).values_list('recipe_id', flat=True))
-        carts = set(ShoppingCart.objects.filter(
-            user=user).values_list('recipe_id', flat=True))
-
-        context.update({
-            'favorited_ids': favorites,
-            'shopping_cart_ids': carts
-        })
-        return context
+    @action(detail=False,
+            methods=['post'],
+            url_path='import',
+            permission_classes=[IsAuthenticated])
+    def import_recipes(self, request):
+        serializer = self.get_serializer(
+            data=request.data,
+            many=True,
+            allow_empty=False,
+            max_length=settings.RECIPE_IMPORT_MAX_SIZE,
+        )
+        serializer.is_valid(raise_exception=True)
+        recipes = serializer.save()
+        serializer = RecipeSerializer(
+            self.get_queryset().filter(
+                pk__in=[recipe.pk for recipe in recipes]
+            ),
+            many=True,
+            context=self.get_serializer_context(),
+        )
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def get_etag_source(self):
+        if self.action == 'list':
+            # Счётчики в списке подставляются в общий шаблон, поколение
+            # 'recipes' от них не сдвигается.
+            return (
+                'recipes', counters_namespace(Recipe),
+                counters_namespace(User),
+            ), (), None
+        row = Recipe.objects.filter(
+            pk=parse_pk(self.kwargs['pk'])
+        ).values_list(
+            'author_id', 'updated_at', 'favorites_count', 'in_carts_count',
+            'author__recipes_count', 'author__followers_count', 'image',
+        ).first()
+        if row is None:
+            return None
+        author_id, updated_at, *_, image = row
+        # Пока копии нет, в ответе ссылка на оригинал: готовность копии
+        # тоже меняет ответ.
+        ready = bool(image) and variant_ready(variant_name(image, 'detail'))
+        return (
+            ('ingredients', f'user:{author_id}'), (*row, ready), updated_at
+        )
 
     @action(detail=True,
             methods=['post', 'delete'],
             permission_classes=[IsAuthenticated])
     def favorite(self, request, pk=None):
-        recipe = get_object_or_404(Recipe, pk=pk)
-        user = request.user
-        favorite_exists = Favorite.objects.filter(
-            user=user, recipe=recipe).exists()
-
-        if request.method == 'POST':
-            if favorite_exists:
-                return Response(
-                    {'detail': 'Рецепт уже в избранном.'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            Favorite.objects.create(user=user, recipe=recipe)
-            serializer = RecipeMinifiedSerializer(recipe)
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-
-        if request.method == 'DELETE':
-            if not favorite_exists:
-                return Response(
-                    {'detail': 'Рецепта нет в избранном.'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            Favorite.objects.filter(user=user, recipe=recipe).delete()
-            return Response(status=status.HTTP_204_NO_CONTENT)
+        return self._change_relation(
+            request, Favorite, pk,
+            'Рецепт уже в избранном.', 'Рецепта нет в избранном.'
+        )
 
     @action(detail=True,
             methods=['post', 'delete'],
             permission_classes=[IsAuthenticated])
     def shopping_cart(self, request, pk=None):
-        recipe = get_object_or_404(Recipe, pk=pk)
-        user = request.user
-        in_cart = ShoppingCart.objects.filter(
-            user=user, recipe=recipe).exists()
+        response = self._change_relation(
+            request, ShoppingCart, pk,
+            'Рецепт уже в списке покупок.', 'Рецепта нет в списке покупок.'
+        )
+        if status.is_success(response.status_code):
+            render_shopping_lists.delay(request.user.id)
+        return response
+
+    @action(detail=False,
+            methods=['post', 'delete'],
+            url_path='favorite',
+            permission_classes=[IsAuthenticated])
+    def favorite_bulk(self, request):
+        """Добавить или убрать из избранного список рецептов."""
+        results = change_relations(request, Favorite.objects, Recipe)
+        return Response({'results': results})
+
+    @action(detail=False,
+            methods=['post', 'delete'],
+            url_path='shopping_cart',
+            permission_classes=[IsAuthenticated])
+    def shopping_cart_bulk(self, request):
+        """Добавить или убрать из списка покупок список рецептов."""
+        results = change_relations(request, ShoppingCart.objects, Recipe)
+        if has_changes(results):
+            render_shopping_lists.delay(request.user.id)
+        return Response({'results': results})
+
+    def _change_relation(self, request, model, pk, exists_message,
+                         missing_message):
+        """Один рецепт в избранное или корзину.
 
+        Добавление - один SELECT полей ответа и один INSERT. Удаление -
+        один DELETE; наличие рецепта проверяется, только если ничего не
+        удалилось.
+        """
+        recipe_id = parse_pk(pk)
         if request.method == 'POST':
-            if in_cart:
+            recipe = get_object_or_404(
+                Recipe.objects.only('id', 'name', 'image', 'cooking_time'),
+                pk=recipe_id,
+            )
+            if not model.objects.add_many(request.user.pk, [recipe_id]):
                 return Response(
-                    {'detail': 'Рецепт уже в списке покупок.'},
+                    {'detail': exists_message},
                     status=status.HTTP_400_BAD_REQUEST
                 )
-            ShoppingCart.objects.create(user=user, recipe=recipe)
             serializer = RecipeMinifiedSerializer(recipe)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-        if request.method == 'DELETE':
-            if not in_cart:
-                return Response(
-                    {'detail': 'Рецепта нет в списке покупок.'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            ShoppingCart.objects.filter(user=user, recipe=recipe).delete()
-            return Response(status=status.HTTP_204_NO_CONTENT)
+        if not model.objects.remove_many(request.user.pk, [recipe_id]):
+            get_object_or_404(Recipe, pk=recipe_id)
+            return Response(
+                {'detail': missing_message},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    def perform_content_negotiation(self, request, force=False):
+        if self.action == 'download_shopping_cart':
+            # Здесь format выбирает формат файла, а не рендерер DRF.
+            renderer = self.get_renderers()[0]
+            return renderer, renderer.media_type
+        return super().perform_content_negotiation(request, force)
 
     @action(detail=False,
             methods=['get'],
             permission_classes=[IsAuthenticated])
     def download_shopping_cart(self, request):
         user = request.user
-        shopping_list = generate_shopping_list(user)
-
-        if not shopping_list.strip():
+        file_format = request.query_params.get('format', 'txt')
+        if file_format not in EXPORT_FORMATS:
+            return Response(
+                {'format': f'Доступные форматы: {", ".join(EXPORT_FORMATS)}.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not user.shopping_cart_ingredients.exists():
             return Response(
                 {'detail': 'Ваш список покупок пуст.'},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        response = HttpResponse(shopping_list, content_type='text/plain')
-        filename = f'shopping_cart_{user.username}.txt'
+        def render():
+            if file_format == 'pdf':
+                # PDF долго собирается: это работа воркера задач, а без
+                # свободного воркера - этого запроса.
+                return render_shopping_list_file.call(
+                    user.id, file_format,
+                    timeout=settings.SHOPPING_LIST_PDF_TIMEOUT,
+                    pickup_timeout=settings.SHOPPING_LIST_PDF_PICKUP_TIMEOUT,
+                )
+            return render_shopping_list(user, file_format)
+
+        # Файл собирается до ответа: ошибка сборки - это 503, а не
+        # оборванное скачивание после заголовков 200.
+        try:
+            content = cached_shopping_list(user, file_format, render)
+        except (TimeoutError, TaskFailedError):
+            return Response(
+                {'detail': 'Не удалось собрать список покупок, '
+                           'попробуйте позже.'},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+        content_type, _ = EXPORT_FORMATS[file_format]
+        response = StreamingHttpResponse(
+            chunked(content), content_type=content_type,
+        )
+        filename = f'shopping_cart_{user.username}.{file_format}'
         response['Content-Disposition'] = f'attachment; filename={filename}'
         return response
 
@@ -142,23 +237,51 @@ class RecipeViewSet(viewsets.ModelViewSet):
         )
 
 
-class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
+class IngredientViewSet(ConditionalGetMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     pagination_class = None
     filter_backends = [DjangoFilterBackend]
     filterset_class = IngredientFilter
+    viewer_dependent = False
 
+    def get_etag_source(self):
+        if self.action == 'list':
+            return ('ingredients',), (), None
+        row = Ingredient.objects.filter(
+            pk=parse_pk(self.kwargs['pk'])
+        ).values_list('name', 'measurement_unit').first()
+        if row is None:
+            return None
+        return ('ingredients',), row, None
+
+    @conditional
     def list(self, request, *args, **kwargs):
-        cache_key = f"ingredients_{request.query_params.get('name', '')}"
-        data = cache.get(cache_key)
-
-        if not data:
-            queryset = self.filter_queryset(self.get_queryset())
-            serializer = self.get_serializer(queryset, many=True)
-            data = serializer.data
-            cache.set(cache_key, data, timeout=60 * 60)
-        return Response(data)
+        if 'search' in request.query_params:
+            return self._search(request, *args, **kwargs)
+        return HttpResponse(
+            ingredient_index.search(request.query_params.get('name', '')),
+            content_type='application/json',
+        )
+
+    def _search(self, request, *args, **kwargs):
+        """Полнотекстовый поиск: готовый JSON в двухуровневом кеше."""
+        def render():
+            response = super(IngredientViewSet, self).list(
+                request, *args, **kwargs
+            )
+            if response.status_code != 200:
+                raise UncacheableResponseError(response)
+            return JSONRenderer().render(response.data)
+
+        try:
+            content = get_or_compute(
+                f'ingredients:search:{request.build_absolute_uri()}',
+                render, settings.CACHE_TTL, ('ingredients',),
+            )
+        except UncacheableResponseError as error:
+            return error.response
+        return HttpResponse(content, content_type='application/json')
 
 
 def short_link_redirect(request, short_id):
@@ -6,15 +6,20 @@ from .models import Follow, User
 
 @admin.register(User)
 class CustomUserAdmin(UserAdmin):
-    list_display = ('email', 'username', 'first_name', 'last_name')
+    list_display = (
+        'email', 'username', 'first_name', 'last_name',
+        'recipes_count', 'followers_count',
+    )
     search_fields = ('email', 'username')
     list_filter = ('email', 'username')
     ordering = ('username',)
+    readonly_fields = ('recipes_count', 'followers_count')
     fieldsets = (
         (None, {'fields': ('email', 'username', 'password')}),
         ('Personal info', {'fields': ('first_name', 'last_name', 'avatar')}),
         ('Permissions', {'fields': ('is_active', 'is_staff', 'is_superuser')}),
         ('Important dates', {'fields': ('last_login', 'date_joined')}),
+        ('Statistics', {'fields': ('recipes_count', 'followers_count')}),
     )
 
 
@@ -1,6 +1,16 @@
+from api.authentication import forget_token, forget_user_tokens
+from core.cache import bump_generations_on_commit
+from core.counters import change_counter, forget_counters, loaded_fields
+from core.relations import UserRelationManager
+from core.viewer_sets import FOLLOWING, viewer_set_changed
 from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from foodgram_api.media import (release_deleted_file, release_replaced_file,
+                                remember_file)
+from rest_framework.authtoken.models import Token
 
 
 class User(AbstractUser):
@@ -27,6 +37,18 @@ class User(AbstractUser):
         null=True,
         verbose_name='Аватар',
     )
+    recipes_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Количество рецептов',
+    )
+    followers_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Количество подписчиков',
+    )
+
+    COUNTER_FIELDS = ('recipes_count', 'followers_count')
 
     class Meta:
         verbose_name = "Пользователь"
@@ -36,6 +58,27 @@ class User(AbstractUser):
     def __str__(self):
         return self.email
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # Счётчики пишет только change_counter (API, админка).
+            kwargs['update_fields'] = loaded_fields(
+                self, self.COUNTER_FIELDS
+            )
+        super().save(*args, **kwargs)
+
+
+class FollowManager(UserRelationManager):
+    target_field = 'following'
+
+    def add_many(self, user_id, target_ids):
+        # Подписка на самого себя запрещена, как и в Follow.clean.
+        return super().add_many(
+            user_id, [pk for pk in target_ids if pk != user_id]
+        )
+
+    def changed(self, user_id, target_ids, delta):
+        follows_changed(user_id, target_ids, delta)
+
 
 class Follow(models.Model):
     user = models.ForeignKey(
@@ -51,6 +94,8 @@ class Follow(models.Model):
         verbose_name='Подписчик',
     )
 
+    objects = FollowManager()
+
     class Meta:
         unique_together = (
             'user',
@@ -69,3 +114,63 @@ class Follow(models.Model):
     def save(self, *args, **kwargs):
         self.clean()
         super().save(*args, **kwargs)
+
+
+@receiver(pre_save, sender=User)
+def remember_avatar(sender, instance, update_fields=None, **kwargs):
+    remember_file(instance, 'avatar', update_fields)
+
+
+@receiver(post_save, sender=User)
+def release_replaced_avatar(sender, instance, **kwargs):
+    release_replaced_file(instance, 'avatar')
+
+
+@receiver(post_delete, sender=User)
+def release_avatar(sender, instance, **kwargs):
+    release_deleted_file(instance, 'avatar')
+
+
+@receiver([post_save, post_delete], sender=User)
+def clear_user_cache(sender, instance, **kwargs):
+    if kwargs.get('update_fields') == {'last_login'}:
+        # Вход пользователя не меняет его данных в ответах API.
+        return
+    # Автор встроен в каждый рецепт списка.
+    bump_generations_on_commit(f'user:{instance.pk}', 'users', 'recipes')
+
+
+def follows_changed(user_id, following_ids, delta):
+    """Счётчики и кеш после изменения подписок пользователя."""
+    change_counter(
+        User.objects.filter(pk__in=following_ids), 'followers_count', delta
+    )
+    # Шаблоны профилей и списков не сбрасываются: followers_count
+    # в них подставляется из кеша счётчиков.
+    forget_counters(User, following_ids)
+    # Поколение зрителя сдвигает viewer_set_changed после коммита.
+    viewer_set_changed(user_id, FOLLOWING, following_ids, delta)
+
+
+@receiver(post_save, sender=User)
+def forget_cached_credentials(sender, instance, update_fields=None,
+                              **kwargs):
+    # Пароль, is_active и прочие поля могли измениться; вход - нет.
+    if update_fields != {'last_login'}:
+        forget_user_tokens(instance.pk)
+
+
+@receiver(post_delete, sender=Token)
+def forget_deleted_token(sender, instance, **kwargs):
+    # Выход djoser и каскадное удаление пользователя удаляют токен.
+    forget_token(instance.key)
+
+
+@receiver([post_save, post_delete], sender=Follow)
+def count_followers(sender, instance, created=None, **kwargs):
+    # post_delete не передаёт created: None - удаление, False - правка.
+    if created is False:
+        return
+    follows_changed(
+        instance.user_id, [instance.following_id], 1 if created else -1
+    )
@@ -1,28 +1,40 @@
-from foodgram_api.image_field import Base64ImageField
+from api.viewer_state import CounterField, get_viewer_state
+from django.db.models import Prefetch
+from foodgram_api.image_field import Base64ImageField, ImageVariantField
+from foodgram_api.images import AVATAR_VARIANTS, schedule_image_variants
+from recipes.models import Recipe
 from recipes.serializers import RecipeMinifiedSerializer
 from rest_framework import serializers
 
-from .models import Follow, User
+from .models import User
+
+
+class AuthorListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        authors = list(data.all() if hasattr(data, 'all') else data)
+        get_viewer_state(self.context).prime(
+            author_ids=[author.id for author in authors]
+        )
+        return super().to_representation(authors)
 
 
 class UserSerializer(serializers.ModelSerializer):
     is_subscribed = serializers.SerializerMethodField()
-    avatar = serializers.ImageField(read_only=True)
+    avatar = ImageVariantField('avatar')
+    recipes_count = CounterField()
+    followers_count = CounterField()
 
     class Meta:
         model = User
         fields = (
             'email', 'id', 'username', 'first_name',
             'last_name', 'is_subscribed', 'avatar',
+            'recipes_count', 'followers_count',
         )
+        list_serializer_class = AuthorListSerializer
 
     def get_is_subscribed(self, obj):
-        request = self.context.get('request')
-        return (
-            request and request.user.is_authenticated
-            and Follow.objects.filter(user=request.user,
-                                      following=obj).exists()
-        )
+        return get_viewer_state(self.context).is_subscribed(obj)
 
 
 class UserCreateSerializer(serializers.ModelSerializer):
@@ -51,6 +63,15 @@ class AvatarUploadSerializer(serializers.ModelSerializer):
         model = User
         fields = ('avatar',)
 
+    def update(self, instance, validated_data):
+        instance.avatar = validated_data['avatar']
+        instance.save(update_fields=['avatar'])
+        schedule_image_variants(
+            instance.avatar, AVATAR_VARIANTS,
+            (f'user:{instance.pk}', 'users', 'recipes'),
+        )
+        return instance
+
 
 class SetPasswordSerializer(serializers.Serializer):
     current_password = serializers.CharField(write_only=True, required=True)
@@ -66,31 +87,45 @@ class SetPasswordSerializer(serializers.Serializer):
 
 class FollowSerializer(serializers.ModelSerializer):
     recipes = serializers.SerializerMethodField()
-    recipes_count = serializers.SerializerMethodField()
     is_subscribed = serializers.SerializerMethodField()
-    avatar = Base64ImageField(read_only=True)
+    avatar = ImageVariantField('avatar')
+    recipes_count = CounterField()
+    followers_count = CounterField()
 
     class Meta:
         model = User
         fields = (
             'email', 'id', 'username', 'first_name',
             'last_name', 'is_subscribed', 'recipes',
-            'recipes_count', 'avatar',
+            'recipes_count', 'followers_count', 'avatar',
         )
+        list_serializer_class = AuthorListSerializer
 
     def get_is_subscribed(self, obj):
-        user = self.context['request'].user
-        return (
-            user.is_authenticated
-            and obj.follower.filter(user=user).exists()
-        )
+        return get_viewer_state(self.context).is_subscribed(obj)
 
     def get_recipes(self, obj):
-        limit = self.context.get('recipes_limit')
-        recipes = obj.recipes.all()
-        if limit and limit.isdigit():
-            recipes = recipes[:int(limit)]
+        recipes = getattr(obj, 'limited_recipes', None)
+        if recipes is None:
+            recipes = obj.recipes.all()
+            limit = parse_recipes_limit(self.context.get('recipes_limit'))
+            if limit is not None:
+                recipes = recipes[:limit]
         return RecipeMinifiedSerializer(recipes, many=True).data
 
-    def get_recipes_count(self, obj):
-        return obj.recipes.count()
+
+def parse_recipes_limit(value):
+    return int(value) if value and value.isdigit() else None
+
+
+def limited_recipes_prefetch(recipes_limit):
+    """Первые recipes_limit рецептов каждого автора одним запросом.
+
+    Срез в Prefetch Django превращает в ROW_NUMBER() OVER (PARTITION BY
+    author_id), поэтому лишние рецепты не читаются из БД.
+    """
+    queryset = Recipe.objects.order_by('-pub_date', '-id')
+    limit = parse_recipes_limit(recipes_limit)
+    if limit is not None:
+        queryset = queryset[:limit]
+    return Prefetch('recipes', queryset=queryset, to_attr='limited_recipes')
@@ -1,19 +1,29 @@
-from api.paginations import CustomPagination
-from django.core.cache import cache
-from django.db.models import Count
+from api.bulk import change_relations, parse_pk
+from api.conditional import ConditionalGetMixin, conditional
+from api.paginations import (CursorPaginationMixin, CustomPagination,
+                             UserCursorPagination)
+from api.response_cache import ResponseCacheMixin
+from core.counters import counters_namespace
+from django.conf import settings
+from django.db.models import prefetch_related_objects
+from django.http import Http404
 from rest_framework import status, viewsets
+from rest_framework.authtoken.models import Token
 from rest_framework.decorators import action
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from users.models import Follow, User
 from users.serializers import (AvatarUploadSerializer, FollowSerializer,
                                SetPasswordSerializer, UserCreateSerializer,
-                               UserSerializer)
+                               UserSerializer, limited_recipes_prefetch)
 
 
-class UserViewSet(viewsets.ModelViewSet):
+class UserViewSet(ConditionalGetMixin, ResponseCacheMixin,
+                  CursorPaginationMixin, viewsets.ModelViewSet):
     queryset = User.objects.all()
     pagination_class = CustomPagination
+    cursor_pagination_class = UserCursorPagination
+    response_cache_namespace = 'users'
     permission_classes = [AllowAny]
 
     def get_serializer_class(self):
@@ -21,16 +31,31 @@ class UserViewSet(viewsets.ModelViewSet):
             return UserCreateSerializer
         return UserSerializer
 
+    def get_etag_source(self):
+        if self.action == 'retrieve':
+            return self._profile_etag_source(parse_pk(self.kwargs['pk']))
+        if self.action == 'me':
+            return self._profile_etag_source(self.request.user.pk)
+        if self.action == 'subscriptions':
+            return ('users', 'recipes', counters_namespace(User)), (), None
+        return ('users', counters_namespace(User)), (), None
+
     @action(
         detail=False,
         methods=['get'],
         permission_classes=[IsAuthenticated],
         url_path="me",
     )
+    @conditional
     def me(self, request):
         """Получить данные текущего пользователя."""
-        serializer = self.get_serializer(request.user)
-        return Response(serializer.data)
+        return self._profile_response(
+            request, request.user.pk,
+            # Свежая запись, а не request.user из кеша аутентификации.
+            lambda: Response(self.get_serializer(
+                User.objects.get(pk=request.user.pk)
+            ).data),
+        )
 
     @action(
         detail=False,
@@ -54,9 +79,11 @@ class UserViewSet(viewsets.ModelViewSet):
 
     def delete_avatar(self, request):
         """Удалить аватар пользователя."""
-        request.user.avatar.delete(save=False)
+        # Файл удалит release_media_file, если он больше никому не нужен.
         request.user.avatar = None
-        request.user.save()
+        # request.user из кеша аутентификации: счётчики в нём могли
+        # устареть, поэтому сохраняем только изменённое поле.
+        request.user.save(update_fields=['avatar'])
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(
@@ -64,14 +91,14 @@ class UserViewSet(viewsets.ModelViewSet):
         methods=['get'],
         permission_classes=[IsAuthenticated],
     )
+    @conditional
     def subscriptions(self, request):
         """Получить подписки пользователя."""
-        queryset = User.objects.filter(following__user=request.user).annotate(
-            recipes_count=Count('recipes')
-        ).prefetch_related('recipes')
+        context = self._get_follow_context(request)
+        queryset = User.objects.filter(
+            following__user=request.user
+        ).prefetch_related(limited_recipes_prefetch(context['recipes_limit']))
         page = self.paginate_queryset(queryset)
-        context = {'request': request,
-                   'recipes_limit': request.query_params.get('recipes_limit')}
         serializer = FollowSerializer(page, many=True, context=context)
         return self.get_paginated_response(serializer.data)
 
@@ -82,36 +109,46 @@ class UserViewSet(viewsets.ModelViewSet):
     )
     def subscribe(self, request, pk=None):
         """Подписаться на пользователя."""
-        author = self.get_object()
-        if author == request.user:
+        if parse_pk(pk) == request.user.pk:
             return Response(
                 {"detail": "You cannot subscribe to yourself."},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        if Follow.objects.filter(user=request.user, following=author).exists():
+        if not Follow.objects.add_many(request.user.pk, [parse_pk(pk)]):
+            self.get_object()
             return Response(
                 {"detail": "You are already subscribed to this user."},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        Follow.objects.create(user=request.user, following=author)
-        serializer = FollowSerializer(
-            author,
-            context=self._get_follow_context(request)
+        author = self.get_object()
+        context = self._get_follow_context(request)
+        prefetch_related_objects(
+            [author], limited_recipes_prefetch(context['recipes_limit'])
         )
+        serializer = FollowSerializer(author, context=context)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     @subscribe.mapping.delete
     def unsubscribe(self, request, pk=None):
         """Отписаться от пользователя."""
-        follow = Follow.objects.filter(
-            user=request.user,
-            following=self.get_object()
-        )
-        if not follow.exists():
+        if not Follow.objects.remove_many(request.user.pk, [parse_pk(pk)]):
+            self.get_object()
             return Response(status=status.HTTP_400_BAD_REQUEST)
-        follow.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @action(
+        detail=False,
+        methods=['post', 'delete'],
+        permission_classes=[IsAuthenticated],
+        url_path='subscribe',
+    )
+    def subscribe_bulk(self, request):
+        """Подписаться на список авторов или отписаться от них."""
+        results = change_relations(
+            request, Follow.objects, User, forbidden={request.user.pk}
+        )
+        return Response({'results': results})
+
     @action(
         detail=False,
         methods=['post'],
@@ -126,7 +163,10 @@ class UserViewSet(viewsets.ModelViewSet):
         )
         serializer.is_valid(raise_exception=True)
         request.user.set_password(serializer.validated_data['new_password'])
-        request.user.save()
+        request.user.save(update_fields=['password'])
+        # Старый пароль мог утечь вместе с токеном: после смены нужен
+        # новый вход. Удаление токена сбрасывает и его кеш.
+        Token.objects.filter(user=request.user).delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     def _get_follow_context(self, request):
@@ -136,13 +176,41 @@ class UserViewSet(viewsets.ModelViewSet):
             'recipes_limit': request.query_params.get('recipes_limit')
         }
 
+    @conditional
     def retrieve(self, request, *args, **kwargs):
-        cache_key = f"user_{kwargs['pk']}_details"
-        data = cache.get(cache_key)
-
-        if not data:
-            instance = self.get_object()
-            serializer = self.get_serializer(instance)
-            data = serializer.data
-            cache.set(cache_key, data, timeout=60 * 15)  # 15 минут
-        return Response(data)
+        # Наличие пользователя уже проверил get_etag_source.
+        return self._profile_response(
+            request, parse_pk(kwargs['pk']),
+            lambda: super(UserViewSet, self).retrieve(
+                request, *args, **kwargs
+            ),
+        )
+
+    def _profile_etag_source(self, pk):
+        """Валидаторы профиля: поколение user:<pk> и счётчики строки.
+
+        Счётчики в шаблоне профиля - метки, поколение от них не
+        сдвигается. Пользователь проверяется до чтения поколений: иначе
+        любой URL создавал бы в Redis бессрочный ключ поколения для
+        несуществующего id.
+        """
+        row = User.objects.filter(pk=pk).values_list(
+            'recipes_count', 'followers_count'
+        ).first()
+        if row is None:
+            raise Http404
+        return (f'user:{pk}',), row, None
+
+    def _profile_response(self, request, pk, produce):
+        """Профиль из кеша, общий для всех зрителей и для /me.
+
+        В кеше нет is_subscribed: флаг подставляется для каждого зрителя,
+        поэтому запись живёт до изменения самого пользователя.
+        """
+        return self.cached_response(
+            request,
+            f"user:{pk}:details:{request.build_absolute_uri('/')}",
+            (f'user:{pk}',),
+            settings.USER_PROFILE_TTL,
+            produce,
+        )